@@ -0,0 +1,340 @@
+"""Benchmarks for data manifest parsing, hashing, verification and sync.
+
+Everything is synthetic: manifests and files are generated in a temporary directory, and syncs
+download from the in-process fake GCS server in tests/fake_gcs_server.py, so the results don't
+depend on network access or on any real bucket. Run the suite and store the results with
+
+    python benchmarks/bench_data_manifest.py --output results.json
+
+and compare two result files (e.g. from two versions of the package) with
+
+    python benchmarks/bench_data_manifest.py --compare old_results.json results.json
+
+Each benchmark's setup runs in this process, and the measured part runs in a forked child so
+that its peak memory use can be measured (as the growth of the child's maximum RSS).
+"""
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import logging
+
+REPO_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'tests'))
+
+from fake_gcs_server import FakeGCSServer  # noqa: E402
+from freenome_build.manifest_index import ManifestIndex  # noqa: E402
+from freenome_build.data_manifest import (  # noqa: E402
+    DataManifestReader, calc_md5sum_from_fname, calc_md5sums_from_fnames
+)
+
+BUCKET = 'benchmarks'
+REMOTE_PREFIX = f'gs://{BUCKET}/reference-data/'
+MANIFEST_HEADER = "name\trelative_local_path\trelative_remote_path\tmd5sum\tsize\tnotes\n"
+
+KB, MB, GB = 1024, 1024*1024, 1024*1024*1024
+# files are filled with a repeated block of random data, which is much faster to generate
+FILL_BLOCK = os.urandom(8*MB)
+
+
+def _md5sum(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+def _write_file(fname, size):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    md5 = hashlib.md5()
+    with open(fname, 'wb') as ofp:
+        remaining = size
+        while remaining > 0:
+            data = FILL_BLOCK[:remaining]
+            md5.update(data)
+            ofp.write(data)
+            remaining -= len(data)
+    return base64.b64encode(md5.digest()).decode('ascii')
+
+
+def _write_manifest(fname, records):
+    """Write a manifest of (name, md5sum, size) tuples, where every path is 'data/{name}'."""
+    with open(fname, 'w') as ofp:
+        ofp.write(MANIFEST_HEADER)
+        for name, md5sum, size in records:
+            ofp.write(f"{name}\tdata/{name}\t{name}\t{md5sum}\t{size}\tbenchmark\n")
+
+
+def _max_rss_bytes():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports the maximum RSS in KB, and macOS in bytes
+    return max_rss if sys.platform == 'darwin' else max_rss*KB
+
+
+def _run_in_child(func):
+    """Run 'func' in a forked child and return (its result, wall time, peak RSS growth)."""
+    context = multiprocessing.get_context('fork')
+    recv_conn, send_conn = context.Pipe(duplex=False)
+
+    def child():
+        try:
+            start_rss = _max_rss_bytes()
+            start_time = time.perf_counter()
+            result = func()
+            wall_time = time.perf_counter() - start_time
+            send_conn.send((None, result, wall_time, _max_rss_bytes() - start_rss))
+        except BaseException as inst:
+            send_conn.send((repr(inst), None, None, None))
+
+    process = context.Process(target=child)
+    process.start()
+    error, result, wall_time, peak_rss = recv_conn.recv()
+    process.join()
+    if error is not None:
+        raise RuntimeError(f"Benchmark failed: {error}")
+    return result, wall_time, peak_rss
+
+
+def _result(name, params, wall_time, peak_rss, n_bytes=None):
+    result = {
+        'name': name,
+        'params': params,
+        'wall_time': wall_time,
+        'peak_rss_delta_bytes': peak_rss,
+    }
+    if n_bytes is not None:
+        result['bytes'] = n_bytes
+        result['throughput'] = n_bytes/wall_time if wall_time > 0 else None
+    return result
+
+
+def bench_load_manifest(dirname, n_records):
+    manifest_fname = os.path.join(dirname, f'load-{n_records}.tsv')
+    _write_manifest(manifest_fname, (
+        (f'record_{i:08d}', _md5sum(str(i).encode()), 1000 + i) for i in range(n_records)))
+    results = []
+
+    _, wall_time, peak_rss = _run_in_child(
+        lambda: len(DataManifestReader(manifest_fname, dirname, REMOTE_PREFIX)))
+    results.append(_result('load_manifest', {'n_records': n_records}, wall_time, peak_rss))
+
+    def build_index():
+        with ManifestIndex.open(manifest_fname) as index:
+            return len(index)
+
+    _, wall_time, peak_rss = _run_in_child(build_index)
+    results.append(_result('build_manifest_index', {'n_records': n_records}, wall_time, peak_rss))
+
+    def open_index():
+        with ManifestIndex.open(manifest_fname) as index:
+            return index[f'record_{n_records//2:08d}'].size
+
+    _, wall_time, peak_rss = _run_in_child(open_index)
+    results.append(_result('open_manifest_index', {'n_records': n_records}, wall_time, peak_rss))
+
+    def load_with_index():
+        manifest = DataManifestReader(manifest_fname, dirname, REMOTE_PREFIX, use_index=True)
+        return manifest[f'record_{n_records//2:08d}'].size
+
+    _, wall_time, peak_rss = _run_in_child(load_with_index)
+    results.append(_result('load_manifest_with_index', {'n_records': n_records}, wall_time, peak_rss))
+    return results
+
+
+def bench_md5sum(dirname, size):
+    fname = os.path.join(dirname, f'md5sum-{size}')
+    _write_file(fname, size)
+    try:
+        _, wall_time, peak_rss = _run_in_child(lambda: calc_md5sum_from_fname(fname))
+    finally:
+        os.remove(fname)
+    return [_result('calc_md5sum_from_fname', {'size': size}, wall_time, peak_rss, size)]
+
+
+def bench_md5sums(dirname, n_files, size, n_jobs):
+    fnames = [os.path.join(dirname, 'md5sums', f'file_{i:06d}') for i in range(n_files)]
+    for fname in fnames:
+        _write_file(fname, size)
+    _, wall_time, peak_rss = _run_in_child(lambda: calc_md5sums_from_fnames(fnames, n_jobs))
+    params = {'n_files': n_files, 'size': size, 'n_jobs': n_jobs}
+    return [_result(
+        'calc_md5sums_from_fnames', params, wall_time, peak_rss, n_files*size)]
+
+
+def _synthetic_manifest(dirname, label, n_records, size, server=None):
+    """Write a manifest of 'n_records' files of 'size' bytes, and upload them to 'server'."""
+    manifest_fname = os.path.join(dirname, f'{label}.tsv')
+    local_prefix = os.path.join(dirname, label)
+    records = []
+    for i in range(n_records):
+        name = f'file_{i:06d}'
+        fname = os.path.join(local_prefix, 'data', name)
+        md5sum = _write_file(fname, size)
+        if server is not None:
+            with open(fname, 'rb') as fp:
+                server.put(BUCKET, f'reference-data/{name}', fp.read())
+            os.remove(fname)
+        records.append((name, md5sum, size))
+    _write_manifest(manifest_fname, records)
+    return manifest_fname, local_prefix
+
+
+def bench_verify(dirname, n_records, size, n_jobs):
+    manifest_fname, local_prefix = _synthetic_manifest(
+        dirname, f'verify-{n_records}-{size}', n_records, size)
+    results = []
+    for check_md5sums in (False, True):
+        def verify():
+            manifest = DataManifestReader(manifest_fname, local_prefix, REMOTE_PREFIX)
+            manifest.verify(local_prefix, check_md5sums=check_md5sums, n_jobs=n_jobs)
+
+        _, wall_time, peak_rss = _run_in_child(verify)
+        params = {
+            'n_records': n_records, 'size': size, 'n_jobs': n_jobs, 'check_md5sums': check_md5sums
+        }
+        results.append(_result('verify', params, wall_time, peak_rss, n_records*size))
+
+    def verify_sizes():
+        manifest = DataManifestReader(manifest_fname, local_prefix, REMOTE_PREFIX)
+        manifest.verify_sizes(local_prefix, n_jobs=n_jobs).raise_for_failures()
+
+    _, wall_time, peak_rss = _run_in_child(verify_sizes)
+    params = {'n_records': n_records, 'size': size, 'n_jobs': n_jobs}
+    results.append(_result('verify_sizes', params, wall_time, peak_rss, n_records*size))
+    return results
+
+
+def bench_sync(dirname, n_records, size, n_jobs, chunk_size=None):
+    with FakeGCSServer() as server:
+        manifest_fname, local_prefix = _synthetic_manifest(
+            dirname, f'sync-{n_records}-{size}-{chunk_size}', n_records, size, server)
+
+        def sync():
+            manifest = DataManifestReader(manifest_fname, local_prefix, REMOTE_PREFIX)
+            manifest.sync(local_prefix, n_jobs=n_jobs, chunk_size=chunk_size, n_chunk_jobs=n_jobs)
+
+        _, wall_time, peak_rss = _run_in_child(sync)
+    params = {'n_records': n_records, 'size': size, 'n_jobs': n_jobs, 'chunk_size': chunk_size}
+    return [_result('sync', params, wall_time, peak_rss, n_records*size)]
+
+
+def run_benchmarks(dirname, quick=False, max_file_size=None, n_jobs=4):
+    """Run the benchmark suite in 'dirname' and return the list of results.
+
+    If 'max_file_size' is set then larger files aren't hashed.
+    """
+    if quick:
+        load_sizes, md5_sizes = [1000], [4*KB, MB]
+        n_small_files, n_sync_records, large_sync_size = 100, 20, 4*MB
+    else:
+        load_sizes, md5_sizes = [10000, 100000], [4*KB, MB, 64*MB, GB, 4*GB]
+        n_small_files, n_sync_records, large_sync_size = 10000, 1000, 64*MB
+    if max_file_size is not None:
+        md5_sizes = [size for size in md5_sizes if size <= max_file_size]
+
+    benchmarks = []
+    for n_records in load_sizes:
+        benchmarks.append((bench_load_manifest, (n_records,)))
+    for size in md5_sizes:
+        benchmarks.append((bench_md5sum, (size,)))
+    benchmarks.append((bench_md5sums, (n_small_files, 4*KB, n_jobs)))
+    benchmarks.append((bench_verify, (n_small_files, 4*KB, n_jobs)))
+    benchmarks.append((bench_sync, (n_sync_records, 64*KB, n_jobs)))
+    # the fake GCS server holds every object in memory, so large syncs are kept to a few files
+    benchmarks.append((bench_sync, (4, large_sync_size, n_jobs)))
+    benchmarks.append((bench_sync, (4, large_sync_size, n_jobs, large_sync_size//8)))
+
+    results = []
+    for func, args in benchmarks:
+        with tempfile.TemporaryDirectory(dir=dirname) as bench_dirname:
+            for result in func(bench_dirname, *args):
+                print(
+                    f"{result['name']:<28} {json.dumps(result['params'], sort_keys=True):<80} "
+                    f"{result['wall_time']:8.3f}s", file=sys.stderr
+                )
+                results.append(result)
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True
+        ).stdout.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old_results, new_results):
+    """Print the ratio of the new to the old wall times for the benchmarks in both result sets."""
+    def key(result):
+        return result['name'], json.dumps(result['params'], sort_keys=True)
+
+    old_wall_times = {key(result): result['wall_time'] for result in old_results['results']}
+    print(f"{'benchmark':<28} {'params':<80} {'old':>9} {'new':>9} {'new/old':>8}")
+    for result in new_results['results']:
+        old_wall_time = old_wall_times.get(key(result))
+        if old_wall_time is None:
+            continue
+        name, params = key(result)
+        print(
+            f"{name:<28} {params:<80} {old_wall_time:8.3f}s {result['wall_time']:8.3f}s "
+            f"{result['wall_time']/old_wall_time:8.2f}"
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='compare two result files instead of running the benchmarks')
+    parser.add_argument(
+        '--quick', action='store_true', help='run a small version of every benchmark')
+    parser.add_argument(
+        '--max-file-size', type=int, default=None,
+        help='the largest file to hash, in bytes (default: hash every size, up to 4 GB)')
+    parser.add_argument(
+        '--jobs', type=int, default=4, help='the number of threads (default: %(default)s)')
+    parser.add_argument(
+        '--tmpdir', default=None, help='the directory to write the synthetic data to')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        with open(args.compare[0]) as old_fp, open(args.compare[1]) as new_fp:
+            compare_results(json.load(old_fp), json.load(new_fp))
+        return
+
+    # per file log messages would dominate the timings of the small file benchmarks
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as dirname:
+        results = run_benchmarks(dirname, args.quick, args.max_file_size, args.jobs)
+    output = {
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'time': time.time(),
+        'quick': args.quick,
+        'max_file_size': args.max_file_size,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as ofp:
+            json.dump(output, ofp, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
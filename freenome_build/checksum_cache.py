@@ -0,0 +1,79 @@
+import os
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def stat_signature(path):
+    """Return a tuple that changes whenever the file at 'path' is modified or replaced."""
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+class ChecksumCache:
+    """A persistent on-disk cache of file md5sums.
+
+    md5sums are stored in a small SQLite database keyed by the file's absolute path, size, mtime
+    and inode. A cached md5sum is only returned if the file's current stat signature matches the
+    signature that it was stored with, so a modified or replaced file is always re-hashed.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        # the connection is shared by the sync/verify worker threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(fname, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS md5sums ("
+                "  path TEXT PRIMARY KEY,"
+                "  size INTEGER NOT NULL,"
+                "  mtime_ns INTEGER NOT NULL,"
+                "  inode INTEGER NOT NULL,"
+                "  md5sum TEXT NOT NULL"
+                ")"
+            )
+
+    def get(self, path, signature=None):
+        """Return the cached md5sum for 'path', or None if it is missing or stale."""
+        path = os.path.abspath(path)
+        if signature is None:
+            signature = stat_signature(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, inode, md5sum FROM md5sums WHERE path = ?", (path,)
+            ).fetchone()
+        if row is None or tuple(row[:3]) != tuple(signature):
+            return None
+        return row[3]
+
+    def set(self, path, md5sum, signature=None):
+        """Store 'md5sum' for the file at 'path'.
+
+        'signature' should be the stat signature of the file *before* it was hashed, so that a
+        file that was modified while it was being hashed is not cached with the wrong md5sum.
+        """
+        path = os.path.abspath(path)
+        if signature is None:
+            signature = stat_signature(path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO md5sums (path, size, mtime_ns, inode, md5sum) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (path, *signature, md5sum)
+            )
+
+    def invalidate(self, path=None):
+        """Remove 'path' from the cache (or every entry if 'path' is None)."""
+        with self._lock, self._conn:
+            if path is None:
+                logger.info(f"Clearing the checksum cache at '{self.fname}'.")
+                self._conn.execute("DELETE FROM md5sums")
+            else:
+                self._conn.execute(
+                    "DELETE FROM md5sums WHERE path = ?", (os.path.abspath(path),))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
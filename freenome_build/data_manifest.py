@@ -1,22 +1,69 @@
+import io
 import os
+import re
+import sys
+import json
+import time
+import bisect
+import fnmatch
 import codecs
+import base64
+import shutil
 import hashlib
+import contextlib
+import threading
 import subprocess
 import logging
-from collections import namedtuple, OrderedDict
+from collections import namedtuple, Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import google_crc32c
 from google.api_core.exceptions import NotFound
 
 import portalocker
 
-from freenome_build.util import get_gcs_blob
+from freenome_build.util import get_gcs_blob, list_gcs_blobs
+from freenome_build.checksum_cache import ChecksumCache, stat_signature
+from freenome_build.transfer_events import JsonLinesEventWriter, TransferSummary, throughput
 
 logger = logging.getLogger(__name__)
 
 # TODOs
 # (1) decide on the interface (eg do we need separate local/remote prefixes)
 # (2) update so that only a single writer can be open at once
-# (3) add 'get_local_path' method
+
+
+# the size of the read buffer used when calculating md5sums
+MD5_BUFFER_SIZE = 8*1024*1024
+
+# the defaults for the 'freenome-build data' command
+DEFAULT_MANIFEST_FNAME = 'data-manifest.tsv'
+DEFAULT_LOCAL_PREFIX = '/srv/reference_data/'
+DEFAULT_REMOTE_PREFIX = 'gs://balrog/reference-data/'
+# legacy manifests are converted by mapping remote paths with the first prefix to local paths
+# with the second prefix (see migrate_legacy_manifest)
+LEGACY_PATH_MAPPING = ('gs://balrog/', '/srv/')
+
+# the number of seconds to wait for a manifest lock before raising an error
+LOCK_TIMEOUT = 60
+# the number of seconds to wait for another process to download a file in get_local_path
+FETCH_LOCK_TIMEOUT = 6*60*60
+# lock waits longer than this many seconds are logged at the INFO level
+LOCK_WAIT_LOG_THRESHOLD = 1.0
+
+# the directory under the local prefix that is used for the content addressed store
+DEFAULT_CONTENT_STORE_DIRNAME = '.content-store'
+# the directory under the local prefix that stores the last synced state of each manifest
+SYNC_STATE_DIRNAME = '.sync-state'
+
+# the default size of the byte ranges that are fetched by open_stream
+STREAM_CHUNK_SIZE = 8*1024*1024
+
+# the number of directory entries that verify_sizes stats in each task
+STAT_BATCH_SIZE = 256
+
+# the maximum number of source blobs in a GCS compose request
+GCS_MAX_COMPOSE_SOURCES = 32
 
 
 class FileAlreadyExistsError(Exception):
@@ -39,21 +86,124 @@ def hex_to_base64(hex_str):
     return codecs.encode(codecs.decode(hex_str, 'hex'), 'base64').strip().decode('ascii')
 
 
-def calc_md5sum_from_fname(fname):
-    hex_str = subprocess.run(
-        ["md5sum", fname],
-        stdout=subprocess.PIPE
-    ).stdout.split()[0].decode('ascii')
-    return hex_to_base64(hex_str)
+def digest_to_base64(digest):
+    return base64.b64encode(digest).decode('ascii')
+
+
+def calc_md5sum_from_fname(fname, buffer_size=MD5_BUFFER_SIZE):
+    """Calculate the base64 encoded md5sum of 'fname' (the format used by GCS).
+
+    The file is read into a single re-used buffer, which is no larger than the file so that hashing
+    many small files doesn't allocate 'buffer_size' bytes for each of them. hashlib releases the
+    GIL while it hashes large buffers, so many files can be hashed in parallel threads (see
+    calc_md5sums_from_fnames).
+    """
+    m = hashlib.md5()
+    with open(fname, 'rb', buffering=0) as fp:
+        buf = bytearray(min(buffer_size, os.fstat(fp.fileno()).st_size or 1))
+        view = memoryview(buf)
+        while True:
+            n_bytes = fp.readinto(buf)
+            if not n_bytes:
+                break
+            m.update(view[:n_bytes])
+    return digest_to_base64(m.digest())
+
+
+def calc_md5sums_from_fnames(fnames, n_jobs=None):
+    """Calculate the md5sums of 'fnames' in parallel.
+
+    Returns a list of base64 encoded md5sums in the same order as 'fnames'.
+    """
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as executor:
+        return list(executor.map(calc_md5sum_from_fname, fnames))
+
+
+def _calc_cached_md5sum(fname, checksum_cache=None, force=False):
+    """Calculate the md5sum of 'fname', using 'checksum_cache' if it is set.
+
+    If 'force' is True then always re-hash the file (and refresh the cache).
+    """
+    if checksum_cache is None:
+        return calc_md5sum_from_fname(fname)
+
+    signature = stat_signature(fname)
+    if not force:
+        md5sum = checksum_cache.get(fname, signature)
+        if md5sum is not None:
+            logger.debug(f"Found cached md5sum '{md5sum}' for '{fname}'.")
+            return md5sum
+    md5sum = calc_md5sum_from_fname(fname)
+    checksum_cache.set(fname, md5sum, signature)
+    return md5sum
 
 
 def calc_md5sum_from_fp(fp):
     fpos = fp.tell()
     m = hashlib.md5()
     fp.seek(0)
-    m.update(fp.read().encode('utf8'))
+    for chunk in iter(lambda: fp.read(MD5_BUFFER_SIZE), ''):
+        m.update(chunk.encode('utf8'))
     fp.seek(fpos)
-    return hex_to_base64(m.hexdigest())
+    return digest_to_base64(m.digest())
+
+
+def get_blob_md5sum(blob):
+    """Return the md5sum of a GCS blob.
+
+    GCS doesn't calculate md5sums for composite objects, so for blobs that were uploaded in parts
+    the md5sum is stored in the blob's metadata.
+    """
+    if blob.md5_hash is not None:
+        return blob.md5_hash
+    return (blob.metadata or {}).get('md5sum')
+
+
+@contextlib.contextmanager
+def _lock_file(lock_fname, shared=False, timeout=LOCK_TIMEOUT, create=True):
+    """Hold a shared (read) or exclusive (write) lock on 'lock_fname'.
+
+    If 'create' is False then 'lock_fname' is not created, and a FileNotFoundError is raised if it
+    doesn't exist. The time spent waiting for the lock is logged so that lock contention is visible.
+    """
+    lock_type = 'shared' if shared else 'exclusive'
+    flags = (portalocker.LOCK_SH if shared else portalocker.LOCK_EX) | portalocker.LOCK_NB
+    lock = portalocker.Lock(lock_fname, 'a' if create else 'r', timeout=timeout, flags=flags)
+    start_time = time.time()
+    lock.acquire()
+    wait_time = time.time() - start_time
+    log_level = logging.INFO if wait_time >= LOCK_WAIT_LOG_THRESHOLD else logging.DEBUG
+    logger.log(log_level, f"Waited {wait_time:.3f}s for the {lock_type} lock on '{lock_fname}'.")
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def _fsync_dir(dirname):
+    """fsync a directory so that a rename inside of it is durable."""
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _imap_unordered(func, items, n_jobs):
+    """Yield '(item, func(item))' for each of 'items' in a pool of 'n_jobs' threads.
+
+    Results are yielded in the order that they complete. If any call raises an exception then the
+    calls that have not started yet are cancelled, and the exception is re-raised.
+    """
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
 
 
 DataManifestRecord = namedtuple(
@@ -62,6 +212,337 @@ DataManifestRecord = namedtuple(
 )
 
 
+# (added, removed, changed) records between two manifests, where 'changed' is a list of
+# (old record, new record) tuples
+ManifestDiff = namedtuple('ManifestDiff', ['added', 'removed', 'changed'])
+
+
+# a local file that failed verification, where 'reason' is 'missing', 'size' or 'md5sum' and
+# 'duration' is the time in seconds that was spent checking the file
+VerifyFailure = namedtuple('VerifyFailure', ['name', 'path', 'reason', 'message', 'duration'])
+
+
+class VerifyReport:
+    """The result of verifying the local files of a manifest, with every failure found."""
+    def __init__(self, local_prefix, check_md5sums=False):
+        self.local_prefix = local_prefix
+        self.check_md5sums = check_md5sums
+        self.n_records = 0
+        self.n_bytes = 0
+        self.failures = []
+        self.duration = None
+        self.hash_time = 0.0
+
+    @property
+    def ok(self):
+        return not self.failures
+
+    @property
+    def missing(self):
+        return [failure for failure in self.failures if failure.reason == 'missing']
+
+    @property
+    def mismatched(self):
+        return [failure for failure in self.failures if failure.reason != 'missing']
+
+    def raise_for_failures(self):
+        """Raise a MissingFileError or FileMismatchError that lists every failure."""
+        if self.ok:
+            return
+        error_type = MissingFileError if self.missing else FileMismatchError
+        raise error_type("\n".join(failure.message for failure in self.failures))
+
+    def to_dict(self):
+        """Return the report as a JSON serializable dict."""
+        return {
+            'local_prefix': self.local_prefix,
+            'check_md5sums': self.check_md5sums,
+            'ok': self.ok,
+            'n_records': self.n_records,
+            'bytes': self.n_bytes,
+            'n_missing': len(self.missing),
+            'n_mismatched': len(self.mismatched),
+            'duration': self.duration,
+            'hash_time': self.hash_time,
+            'failures': [dict(failure._asdict()) for failure in self.failures],
+        }
+
+
+def _parse_manifest_lines(lines, fname):
+    """Return the header and an OrderedDict of the records in the manifest 'lines'."""
+    header, records = None, OrderedDict()
+    for line_i, line in enumerate(lines):
+        # read the header
+        if line_i == 0:
+            header = line.strip("\n").split("\t")
+            continue
+        # skip empty lines
+        if line.strip() == '':
+            continue
+        # parse and store this record to the ordered dict
+        record = DataManifestRecord(*line.strip("\n").split("\t"))
+        if record.name in records:
+            raise KeyAlreadyExistsError(f"'{record.name}' is duplicated in '{fname}'")
+        records[record.name] = record
+    return header, records
+
+
+def read_manifest_records(manifest_fname, revision=None):
+    """Return an OrderedDict of the records in 'manifest_fname'.
+
+    If 'revision' is set then the manifest is read from that git revision (e.g. 'HEAD~1') of the
+    repository that contains 'manifest_fname', rather than from the working copy.
+    """
+    if revision is None:
+        with open(manifest_fname) as fp:
+            return _parse_manifest_lines(fp, manifest_fname)[1]
+    dirname, basename = os.path.split(os.path.abspath(manifest_fname))
+    data = subprocess.run(
+        ['git', 'show', f'{revision}:./{basename}'],
+        cwd=dirname, stdout=subprocess.PIPE, check=True
+    ).stdout.decode('utf8')
+    return _parse_manifest_lines(data.splitlines(), f'{revision}:{manifest_fname}')[1]
+
+
+def diff_manifests(old_records, new_records):
+    """Return the ManifestDiff between two mappings from names to DataManifestRecords."""
+    added = [record for name, record in new_records.items() if name not in old_records]
+    removed = [record for name, record in old_records.items() if name not in new_records]
+    changed = [
+        (old_records[name], record) for name, record in new_records.items()
+        if name in old_records and old_records[name] != record
+    ]
+    return ManifestDiff(added, removed, changed)
+
+
+def _sync_key(record):
+    """Return the fields of a record that determine the synced local file (i.e. not the notes)."""
+    if record is None:
+        return None
+    return (record.relative_local_path, record.relative_remote_path, record.md5sum, record.size)
+
+
+# the result of downloading a blob: its md5sum, the seconds spent hashing it and the number of
+# bytes that were already downloaded by an earlier, interrupted download
+_DownloadResult = namedtuple('_DownloadResult', ['md5sum', 'hash_time', 'resumed_bytes'])
+
+
+class _ByteBudget:
+    """Limit the total number of bytes that are being transferred at once.
+
+    A transfer that is larger than the whole budget is allowed to proceed
+    once nothing else is in flight, so that a single large file can never
+    dead lock the sync.
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._in_flight = 0
+        self._cv = threading.Condition()
+
+    def _has_room_for(self, n_bytes):
+        return (
+            self.max_bytes is None
+            or self._in_flight == 0
+            or self._in_flight + n_bytes <= self.max_bytes
+        )
+
+    @contextlib.contextmanager
+    def reserve(self, n_bytes):
+        with self._cv:
+            self._cv.wait_for(lambda: self._has_room_for(n_bytes))
+            self._in_flight += n_bytes
+        try:
+            yield
+        finally:
+            with self._cv:
+                self._in_flight -= n_bytes
+                self._cv.notify_all()
+
+
+# the 'tags=' field in a record's notes
+_TAGS_RE = re.compile(r'(?:^|\s)tags=(\S*)')
+
+
+def parse_tags(notes):
+    """Return the tags in a record's notes field.
+
+    Tags are listed in the notes as 'tags=' followed by comma separated tags, e.g.
+    'GRCh38 reference tags=hg38,fasta'. The rest of the notes is free text, and isn't tagged.
+    """
+    return [tag for tags in _TAGS_RE.findall(notes) for tag in tags.split(',') if tag]
+
+
+class _SelectionIndex:
+    """Indexes of a manifest's records by tag and local path (see _DataManifestBase.select)."""
+    def __init__(self, records):
+        self.positions = {}
+        self.names_by_tag = defaultdict(list)
+        local_paths = []
+        for position, record in enumerate(records):
+            self.positions[record.name] = position
+            for tag in parse_tags(record.notes):
+                self.names_by_tag[tag].append(record.name)
+            local_paths.append((os.path.normpath(record.relative_local_path), record.name))
+        self.local_paths = sorted(local_paths)
+
+    def match_pattern(self, pattern):
+        """Return the names of the records whose local path matches the glob 'pattern'."""
+        pattern = os.path.normpath(pattern)
+        # only paths that start with the part of the pattern before the first wildcard can match,
+        # so we only need to check that range of the sorted paths
+        prefix = re.split(r'[*?[]', pattern, 1)[0]
+        names = []
+        for path, name in self.local_paths[bisect.bisect_left(self.local_paths, (prefix,)):]:
+            if not path.startswith(prefix):
+                break
+            if fnmatch.fnmatchcase(path, pattern):
+                names.append(name)
+        return names
+
+
+class _ContentStore:
+    """A content addressed store of downloaded files, keyed by md5sum.
+
+    Manifest paths are materialized as hard links to files in the store, so each unique file is
+    downloaded and stored once however many paths (or manifests) reference it. Stored files are
+    made read only because modifying a hard link in place would modify every copy.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, md5sum):
+        hex_md5sum = base64.b64decode(md5sum).hex()
+        return os.path.join(self.root, hex_md5sum[:2], hex_md5sum)
+
+    def add(self, md5sum, local_abs_path):
+        """Seed the store with 'local_abs_path', a local file that has already been verified."""
+        store_path = self.path(md5sum)
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        tmp_path = f"{store_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            try:
+                os.link(local_abs_path, tmp_path)
+            except OSError:
+                shutil.copyfile(local_abs_path, tmp_path)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, store_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def link(self, md5sum, local_abs_path):
+        """Materialize the stored file with 'md5sum' at 'local_abs_path'."""
+        os.makedirs(os.path.dirname(local_abs_path), exist_ok=True)
+        tmp_path = f"{local_abs_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            try:
+                os.link(self.path(md5sum), tmp_path)
+            except OSError:
+                # hard links can't cross file systems, so fall back to copying the file
+                shutil.copyfile(self.path(md5sum), tmp_path)
+            os.replace(tmp_path, local_abs_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class _HashingWriter:
+    """Wrap a binary file object so that bytes are md5 hashed as they are written to it."""
+    def __init__(self, fp):
+        self.fp = fp
+        self.n_bytes = 0
+        self.hash_time = 0.0
+        self._md5 = hashlib.md5()
+
+    def write(self, data):
+        start_time = time.time()
+        self._md5.update(data)
+        self.hash_time += time.time() - start_time
+        self.n_bytes += len(data)
+        return self.fp.write(data)
+
+    def md5sum(self):
+        return digest_to_base64(self._md5.digest())
+
+
+class _BlobStream(io.RawIOBase):
+    """A read only, forward only stream over a GCS blob (see DataManifestReader.open_stream).
+
+    The blob is fetched in byte range chunks of 'chunk_size' bytes, and up to 'n_read_ahead'
+    chunks after the one that is being read are fetched in the background. The data is md5 hashed
+    as it is read, and reading the end of the stream raises a FileMismatchError if the size or
+    md5sum don't match the record.
+    """
+    def __init__(self, blob, record, chunk_size=STREAM_CHUNK_SIZE, n_read_ahead=2):
+        self.blob = blob
+        self.record = record
+        self.chunk_size = chunk_size
+        self.n_read_ahead = n_read_ahead
+        self._size = int(record.size)
+        self._md5 = hashlib.md5()
+        self._n_bytes_read = 0
+        self._next_fetch_offset = 0
+        self._buffer = memoryview(b'')
+        self._verified = False
+        self._pool = ThreadPoolExecutor(max_workers=max(n_read_ahead, 1))
+        self._fetches = deque()
+
+    def readable(self):
+        return True
+
+    def _fetch(self, start, end):
+        data = self.blob.download_as_bytes(start=start, end=end - 1)
+        if len(data) != end - start:
+            raise FileMismatchError(
+                f"Received {len(data)} bytes for bytes {start}-{end - 1} of "
+                f"'{self.record.relative_remote_path}' (expected {end - start})"
+            )
+        return data
+
+    def _schedule_fetches(self):
+        # the chunk that is being waited on and 'n_read_ahead' chunks after it
+        while len(self._fetches) <= self.n_read_ahead and self._next_fetch_offset < self._size:
+            start = self._next_fetch_offset
+            end = min(start + self.chunk_size, self._size)
+            self._fetches.append(self._pool.submit(self._fetch, start, end))
+            self._next_fetch_offset = end
+
+    def _verify(self):
+        self._verified = True
+        md5sum = digest_to_base64(self._md5.digest())
+        if md5sum != self.record.md5sum:
+            raise FileMismatchError(
+                f"Streamed '{self.record.relative_remote_path}' has md5sum '{md5sum}' "
+                f"vs '{self.record.md5sum}' in the manifest"
+            )
+
+    def readinto(self, b):
+        if not self._buffer:
+            if self._n_bytes_read == self._size:
+                if not self._verified:
+                    self._verify()
+                return 0
+            self._schedule_fetches()
+            data = self._fetches.popleft().result()
+            self._md5.update(data)
+            self._buffer = memoryview(data)
+            self._schedule_fetches()
+        n_bytes = min(len(b), len(self._buffer))
+        b[:n_bytes] = self._buffer[:n_bytes]
+        self._buffer = self._buffer[n_bytes:]
+        self._n_bytes_read += n_bytes
+        return n_bytes
+
+    def close(self):
+        if not self.closed:
+            for fetch in self._fetches:
+                fetch.cancel()
+            self._pool.shutdown(wait=False)
+            self._fetches.clear()
+            self._buffer = memoryview(b'')
+        super().close()
+
+
 class _DataManifestBase(OrderedDict):
     """Track and manage data file dependencies
 
@@ -73,126 +554,1067 @@ class _DataManifestBase(OrderedDict):
     Q1) Do we need a remote_base_path?
     Q2) Can the remote relative path be the same as the local relative path?
     """
+    # the ManifestIndex that records are read from, if the manifest was opened with 'use_index'
+    # (see DataManifestReader)
+    _index = None
+
     def _get_gcs_blob(self, remote_relative_path):
         return get_gcs_blob(self.remote_prefix, remote_relative_path)
 
-    def _verify_record(self, record, local_abs_path, check_md5sums=True):
-        """Verify that the file at 'local_abs_path' matches that in record.
+    def __setitem__(self, name, record):
+        self._selection_index = None
+        super().__setitem__(name, record)
+
+    def __delitem__(self, name):
+        self._selection_index = None
+        super().__delitem__(name)
 
-        If check_md5sums is True then verify that the md5sums match (this is slow).
+    def select(self, names=None, pattern=None, tag=None):
+        """Return the records that match all of the given selections, in manifest order.
+
+        'names' is a list of record names, 'pattern' is a glob that is matched against each record's
+        relative local path, and 'tag' is one of the tags in the record's notes (see parse_tags).
+        If nothing is selected then all of the records are returned.
         """
-        # check that the file exists
-        if not os.path.exists(local_abs_path):
-            raise MissingFileError("Can not find '{record.name}' at '{local_abs_path}'")
+        if names is None and pattern is None and tag is None:
+            return list(self.values())
 
-        # ensure the filesizes match
-        local_fsize = os.path.getsize(local_abs_path)
-        logger.debug(f"Calculated filesize '{local_fsize}' for '{local_abs_path}'.")
-        if local_fsize != int(record.size):
-            raise FileMismatchError(
-                f"'{local_abs_path}' has size '{local_fsize}' vs '{record.size}' in the manifest")
-
-        # ensure the md5sum matches
-        if check_md5sums:
-            logger.info(f"Calculating md5sum for '{local_abs_path}'.")
-            local_md5sum = calc_md5sum_from_fname(local_abs_path)
-            logger.debug(f"Calculated md5sum '{local_md5sum}' for '{local_abs_path}'.")
-            if local_md5sum != record.md5sum:
-                raise FileMismatchError(
-                    f"'{local_abs_path}' has md5sum '{local_md5sum}' "
+        if self._index is not None and pattern is None and tag is None:
+            # look the names up in the index rather than loading every record
+            for name in names:
+                if name not in self:
+                    raise KeyError(f"'{name}' is not in '{self.fname}'")
+            return [self[name] for name in sorted(set(names), key=self._index.position)]
+
+        if self._selection_index is None:
+            self._selection_index = _SelectionIndex(self.values())
+        index = self._selection_index
+
+        selections = []
+        if names is not None:
+            for name in names:
+                if name not in self:
+                    raise KeyError(f"'{name}' is not in '{self.fname}'")
+            selections.append(set(names))
+        if pattern is not None:
+            selections.append(set(index.match_pattern(pattern)))
+        if tag is not None:
+            selections.append(set(index.names_by_tag.get(tag, [])))
+        selected = set.intersection(*selections)
+        logger.debug(f"Selected {len(selected)}/{len(self)} records from '{self.fname}'.")
+        return [self[name] for name in sorted(selected, key=index.positions.__getitem__)]
+
+    def _remote_list_prefixes(self, records):
+        """Return the smallest set of remote directories that contain all of 'records'."""
+        dirnames = sorted({
+            os.path.dirname(record.relative_remote_path).rstrip('/') for record in records})
+        prefixes = []
+        chosen = set()
+        for dirname in dirnames:
+            # skip directories that are inside of a directory that will already be listed. Sorting
+            # puts every ancestor before its descendants, but not necessarily immediately before
+            # them (e.g. 'a', 'a-b', 'a/b'), so check all of the ancestors
+            parts = dirname.split('/') if dirname else []
+            ancestors = [''] + ['/'.join(parts[:i]) for i in range(1, len(parts))]
+            if any(ancestor in chosen for ancestor in ancestors):
+                continue
+            chosen.add(dirname)
+            prefixes.append(dirname)
+        return [prefix + '/' if prefix else '' for prefix in prefixes]
+
+    def _list_remote_blobs(self, records, n_jobs=1):
+        """Return a dict mapping remote relative paths to blobs for the directories of 'records'."""
+        def list_prefix(prefix):
+            return dict(list_gcs_blobs(
+                self.remote_prefix, prefix, fields='items(name,size,md5Hash,metadata),nextPageToken'))
+
+        remote_blobs = {}
+        for prefix, blobs in _imap_unordered(list_prefix, self._remote_list_prefixes(records), n_jobs):
+            logger.debug(f"Listed {len(blobs)} blobs in '{self.remote_prefix}{prefix}'.")
+            remote_blobs.update(blobs)
+        return remote_blobs
+
+    def verify_remote(self, n_jobs=1, names=None, pattern=None, tag=None):
+        """Ensure that the remote files match the manifest.
+
+        The remote directories are listed in bulk (one paginated request per directory, 'n_jobs'
+        directories at a time) rather than requesting each blob's metadata separately. Every record
+        is checked before raising a MissingFileError (if any remote files are missing) or a
+        FileMismatchError that lists all of the problems. 'names', 'pattern' and 'tag' restrict the
+        records that are checked (see select).
+        """
+        records = self.select(names, pattern, tag)
+        remote_blobs = self._list_remote_blobs(records, n_jobs)
+        missing, mismatched = [], []
+        for record in records:
+            remote_path = f"{self.remote_prefix}{record.relative_remote_path}"
+            blob = remote_blobs.get(record.relative_remote_path)
+            if blob is None:
+                missing.append(f"Can not find '{record.name}' at '{remote_path}'")
+            elif blob.size != int(record.size):
+                mismatched.append(
+                    f"'{remote_path}' has size '{blob.size}' vs '{record.size}' in the manifest")
+            elif get_blob_md5sum(blob) != record.md5sum:
+                mismatched.append(
+                    f"'{remote_path}' has md5sum '{get_blob_md5sum(blob)}' "
                     f"vs '{record.md5sum}' in the manifest"
                 )
 
-    def __init__(self, manifest_fname, local_prefix, remote_prefix):
+        for msg in missing + mismatched:
+            logger.error(msg)
+        if missing:
+            raise MissingFileError("\n".join(missing + mismatched))
+        if mismatched:
+            raise FileMismatchError("\n".join(mismatched))
+        logger.info(f"Verified {len(records)} records against '{self.remote_prefix}'.")
+
+    def _calc_md5sum(self, fname, force=False):
+        """Calculate the md5sum of 'fname', using the checksum cache if there is one."""
+        return _calc_cached_md5sum(fname, self.checksum_cache, force)
+
+    def _check_record(self, record, local_abs_path, check_md5sums=True, force=False):
+        """Check that the file at 'local_abs_path' matches that in record.
+
+        If check_md5sums is True then check that the md5sums match (this is slow unless the
+        md5sum is in the checksum cache). If force is True then ignore the checksum cache.
+
+        Returns a VerifyFailure (or None if the file matches) and the verify event.
+        """
+        start_time = time.time()
+        hash_time = 0.0
+        local_fsize = None
+        reason, message = None, None
+        # check that the file exists
+        if not os.path.exists(local_abs_path):
+            reason, message = 'missing', f"Can not find '{record.name}' at '{local_abs_path}'"
+        else:
+            # ensure the filesizes match
+            local_fsize = os.path.getsize(local_abs_path)
+            logger.debug(f"Calculated filesize '{local_fsize}' for '{local_abs_path}'.")
+            if local_fsize != int(record.size):
+                reason, message = 'size', (
+                    f"'{local_abs_path}' has size '{local_fsize}' vs '{record.size}' in the manifest")
+            # ensure the md5sum matches
+            elif check_md5sums:
+                logger.info(f"Calculating md5sum for '{local_abs_path}'.")
+                hash_start_time = time.time()
+                local_md5sum = self._calc_md5sum(local_abs_path, force=force)
+                hash_time = time.time() - hash_start_time
+                logger.debug(f"Calculated md5sum '{local_md5sum}' for '{local_abs_path}'.")
+                if local_md5sum != record.md5sum:
+                    reason, message = 'md5sum', (
+                        f"'{local_abs_path}' has md5sum '{local_md5sum}' "
+                        f"vs '{record.md5sum}' in the manifest"
+                    )
+
+        duration = time.time() - start_time
+        failure = None
+        if reason is not None:
+            failure = VerifyFailure(record.name, local_abs_path, reason, message, duration)
+        event = self._emit(
+            'verify', name=record.name, path=local_abs_path, bytes=local_fsize,
+            duration=duration, hash_time=hash_time, check_md5sums=check_md5sums, failure=reason
+        )
+        return failure, event
+
+    def _verify_record(self, record, local_abs_path, check_md5sums=True, force=False):
+        """Verify that the file at 'local_abs_path' matches that in record, and return the event.
+
+        Raises a MissingFileError or FileMismatchError if it doesn't (see _check_record).
+        """
+        failure, event = self._check_record(record, local_abs_path, check_md5sums, force)
+        if failure is not None:
+            error_type = MissingFileError if failure.reason == 'missing' else FileMismatchError
+            raise error_type(failure.message)
+        return event
+
+    def __init__(
+            self,
+            manifest_fname,
+            local_prefix,
+            remote_prefix,
+            checksum_cache=None,
+            local_cache=None,
+            event_callback=None
+    ):
+        """Load the manifest in 'manifest_fname'.
+
+        'checksum_cache' is either a ChecksumCache or the filename of one to open. If it is set
+        then the md5sums of local files are only re-calculated when their size, mtime or inode
+        have changed.
+
+        'local_cache' is an optional LocalCache. If it is set then the access times of synced
+        files are tracked, and the least recently used files are evicted to keep the local files
+        within the cache's byte budget.
+
+        'event_callback' is called with a dict for every file that is transferred or verified,
+        and with a summary at the end of each sync and verify (see transfer_events). It can also
+        be the filename of a JSON lines file to append the events to.
+
+        A checksum cache or event file that is opened from a filename is closed by close (or at
+        the end of a 'with' block).
+        """
         self.fname = manifest_fname
         self.remote_prefix = remote_prefix
         self.local_prefix = local_prefix
 
+        self._opened = []
+        if isinstance(checksum_cache, str):
+            checksum_cache = ChecksumCache(checksum_cache)
+            self._opened.append(checksum_cache)
+        self.checksum_cache = checksum_cache
+        self.local_cache = local_cache
+        if isinstance(event_callback, str):
+            event_callback = JsonLinesEventWriter(event_callback)
+            self._opened.append(event_callback)
+        self.event_callback = event_callback
+
         self.header = None
+        self._selection_index = None
 
-        # we lock the file to ensure that only one file is doing this at a time
-        # XXX -- only allow one reader at a time
-        with portalocker.Lock(self.fname, 'r') as fp:
-            # store the md5sum so that we can tell
-            # if the file has been modified before writing it out
-            self._md5sum = calc_md5sum_from_fp(fp)
-
-            # read all of the file contents into memory
-            for line_i, line in enumerate(fp):
-                # read the header
-                if line_i == 0:
-                    self.header = line.strip("\n").split("\t")
-                    continue
-                # skip empty lines
-                if line.strip() == '':
-                    continue
-                # parse and store this record to the ordered dict
-                record = DataManifestRecord(*line.strip("\n").split("\t"))
-                if record.name in self:
-                    raise KeyAlreadyExistsError("'{record.name}' is duplicated in '{self.fname}'")
-                self[record.name] = record
+        # writers replace the manifest with an atomic rename (see DataManifestWriter._save_to_disk)
+        # so we can never see a partially written file, but we take a shared lock so that we don't
+        # load a manifest that is in the middle of being replaced. Readers never block each other.
+        with self._read_lock(), open(self.fname) as fp:
+            # the stat signature changes every time that the manifest is replaced, so we use it as
+            # the manifest's generation number
+            self.generation = stat_signature(fp.fileno())
+            self._load(fp)
+
+    def _load(self, fp):
+        """Load the records from the open manifest 'fp'."""
+        # store the md5sum so that we can tell
+        # if the file has been modified before writing it out
+        self._md5sum = calc_md5sum_from_fp(fp)
+
+        # read all of the file contents into memory
+        self.header, records = _parse_manifest_lines(fp, self.fname)
+        self.update(records)
+
+    def close(self):
+        """Close the checksum cache and event file, if they were opened from filenames."""
+        while self._opened:
+            self._opened.pop().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _emit(self, event_type, **fields):
+        """Build an event, pass it to the event callback (if there is one) and return it."""
+        event = dict(event=event_type, time=time.time(), manifest=self.fname, **fields)
+        if self.event_callback is not None:
+            self.event_callback(event)
+        return event
+
+    @property
+    def lock_fname(self):
+        return f"{self.fname}.lock"
+
+    @contextlib.contextmanager
+    def _read_lock(self):
+        """Hold a shared lock on the manifest's lock file, if a writer has created one.
+
+        Only writers create the lock file, so reading a manifest never writes to its directory.
+        Writers replace the manifest atomically, so a reader that finds no lock file (or can't
+        open it) still reads either the old or the new manifest.
+        """
+        with contextlib.ExitStack() as stack:
+            try:
+                stack.enter_context(_lock_file(self.lock_fname, shared=True, create=False))
+            except OSError as inst:
+                logger.debug(f"Reading '{self.fname}' without a lock ({inst}).")
+            yield
+
+    def is_stale(self):
+        """Return True if the manifest on disk has been replaced since it was loaded."""
+        return stat_signature(self.fname) != self.generation
 
 
 class DataManifestReader(_DataManifestBase):
-    def _sync_record(self, record, local_abs_path):
+    def __init__(self, *args, use_index=False, **kwargs):
+        """Load the manifest (see _DataManifestBase).
+
+        If 'use_index' is True then the records aren't parsed into memory. Instead they are read
+        lazily from the manifest's index (see manifest_index), which is built the first time that
+        it is needed and rebuilt whenever the manifest changes. This makes opening a large manifest
+        and looking up a few records (e.g. with get_local_path or select(names=...)) much faster.
+        If the index can't be built (e.g. because the manifest's directory is read only) then the
+        manifest is parsed as usual.
+        """
+        self._use_index = use_index
+        super().__init__(*args, **kwargs)
+
+    def _load(self, fp):
+        if not self._use_index:
+            super()._load(fp)
+            return
+        # manifest_index imports this module
+        from freenome_build.manifest_index import ManifestIndex
+        try:
+            self._index = ManifestIndex.open(self.fname)
+        except OSError as exc:
+            logger.warning(f"Can not use an index for '{self.fname}', parsing it instead: {exc}")
+            super()._load(fp)
+            return
+        self._md5sum = self._index.md5sum
+        self.header = self._index.header.split("\t")
+
+    # when the records are read from an index the OrderedDict is empty, so the mapping methods
+    # are served by the index instead
+    def __getitem__(self, name):
+        if self._index is None:
+            return super().__getitem__(name)
+        return self._index[name]
+
+    def __contains__(self, name):
+        if self._index is None:
+            return super().__contains__(name)
+        return name in self._index
+
+    def __iter__(self):
+        if self._index is None:
+            return super().__iter__()
+        return iter(self._index)
+
+    def __len__(self):
+        if self._index is None:
+            return super().__len__()
+        return len(self._index)
+
+    def get(self, name, default=None):
+        if self._index is None:
+            return super().get(name, default)
+        return self._index.get(name, default)
+
+    def keys(self):
+        if self._index is None:
+            return super().keys()
+        return self._index.keys()
+
+    def values(self):
+        if self._index is None:
+            return super().values()
+        return list(self._index.records())
+
+    def items(self):
+        if self._index is None:
+            return super().items()
+        return [(record.name, record) for record in self._index.records()]
+
+    def close(self):
+        """Close the manifest's index (if it has one), checksum cache and event file."""
+        if self._index is not None:
+            self._index.close()
+        super().close()
+
+    def _sync_record(
+            self, record, local_abs_path, byte_budget=None, chunk_size=None, n_chunk_jobs=1):
+        """Sync 'record' to 'local_abs_path' and return the verify or download event."""
         # if local_path already exists, then make sure that it matches the remote file
         if os.path.exists(local_abs_path):
-            self._verify_record(record, local_abs_path)
+            return self._verify_record(record, local_abs_path)
         # otherwise, copy it to the correct location
+        if byte_budget is None:
+            byte_budget = _ByteBudget()
+        with byte_budget.reserve(int(record.size)):
+            return self._download_record(record, local_abs_path, chunk_size, n_chunk_jobs)
+
+    def _sync_records_via_store(
+            self, records, local_prefix, store, byte_budget, chunk_size=None, n_chunk_jobs=1):
+        """Sync 'records', which all have the same md5sum, through the content store 'store'.
+
+        The store can be shared by processes on several hosts (e.g. on a shared file system). The
+        first process to lock '{store_path}.lock' fills the store, and the rest wait for the lock
+        and then link or copy the stored file. If one of the records' local files already exists
+        and matches the manifest then the store is seeded from it, and the file is only downloaded
+        if there is no local copy. Existing local copies are replaced with links to the stored
+        file (when it is on the same file system) so that they are only stored once.
+
+        Returns the download event if this process downloaded the file, and None otherwise.
+        """
+        event = None
+        store_path = store.path(records[0].md5sum)
+        local_abs_paths = [
+            os.path.join(local_prefix, record.relative_local_path) for record in records]
+        verified = set()
+        if not os.path.exists(store_path):
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+            lock_fname = f"{store_path}.lock"
+            with _lock_file(lock_fname, timeout=FETCH_LOCK_TIMEOUT):
+                # another process may have downloaded the file while we were waiting for the lock
+                if not os.path.exists(store_path):
+                    for record, local_abs_path in zip(records, local_abs_paths):
+                        if os.path.exists(local_abs_path) \
+                                and self._check_record(record, local_abs_path)[0] is None:
+                            logger.debug(f"Adding '{local_abs_path}' to the content store.")
+                            store.add(record.md5sum, local_abs_path)
+                            verified.add(local_abs_path)
+                            break
+                    else:
+                        with byte_budget.reserve(int(records[0].size)):
+                            event = self._download_record(
+                                records[0], store_path, chunk_size, n_chunk_jobs)
+                        os.chmod(store_path, 0o444)
+                    # anything that acquires the lock after this point will find the stored file
+                    os.remove(lock_fname)
+
+        store_dev = os.stat(store_path).st_dev
+        for record, local_abs_path in zip(records, local_abs_paths):
+            if os.path.exists(local_abs_path):
+                if local_abs_path not in verified:
+                    self._verify_record(record, local_abs_path)
+                local_stat = os.stat(local_abs_path)
+                # files that are already linked, or that can't be linked, are left alone
+                if os.path.samefile(local_abs_path, store_path) or local_stat.st_dev != store_dev:
+                    continue
+            logger.debug(f"Linking '{store_path}' to '{local_abs_path}'.")
+            store.link(record.md5sum, local_abs_path)
+            if self.checksum_cache is not None:
+                self.checksum_cache.set(local_abs_path, record.md5sum)
+        return event
+
+    @staticmethod
+    def _check_download(record, local_fsize, local_md5sum):
+        if local_fsize != int(record.size):
+            raise FileMismatchError(
+                f"Downloaded '{record.relative_remote_path}' has size '{local_fsize}' "
+                f"vs '{record.size}' in the manifest"
+            )
+        if local_md5sum != record.md5sum:
+            raise FileMismatchError(
+                f"Downloaded '{record.relative_remote_path}' has md5sum '{local_md5sum}' "
+                f"vs '{record.md5sum}' in the manifest"
+            )
+
+    def _download_record(self, record, local_abs_path, chunk_size=None, n_chunk_jobs=1):
+        """Download 'record' to 'local_abs_path', verify its size and md5sum and return the event.
+
+        Files larger than 'chunk_size' are downloaded in resumable byte range chunks (see
+        _download_blob_in_chunks), everything else is streamed by _download_blob.
+        """
+        logger.info(f"Copying '{record.relative_remote_path}' to '{local_abs_path}'.")
+        start_time = time.time()
+        blob = self._get_gcs_blob(record.relative_remote_path)
+        # make sure the directory exists
+        os.makedirs(os.path.dirname(local_abs_path), exist_ok=True)
+        chunked = chunk_size is not None and int(record.size) > chunk_size
+        if chunked:
+            result = self._download_blob_in_chunks(
+                blob, record, local_abs_path, chunk_size, n_chunk_jobs)
+        else:
+            result = self._download_blob(blob, record, local_abs_path)
+
+        if self.checksum_cache is not None:
+            self.checksum_cache.set(local_abs_path, result.md5sum)
+        duration = time.time() - start_time
+        logger.info(
+            f"Copied '{record.relative_remote_path}' ({record.size} bytes) to "
+            f"'{local_abs_path}' in {duration:.1f}s."
+        )
+        return self._emit(
+            'download', name=record.name, path=local_abs_path, bytes=int(record.size),
+            duration=duration, transfer_time=duration - result.hash_time,
+            hash_time=result.hash_time, throughput=throughput(int(record.size), duration),
+            chunked=chunked, resumed_bytes=result.resumed_bytes
+        )
+
+    def _download_blob(self, blob, record, local_abs_path):
+        """Stream 'blob' to 'local_abs_path' and return a _DownloadResult.
+
+        The md5sum is calculated as the blob is written to a temporary file next to
+        'local_abs_path', which is renamed into place once it has been verified. This means that
+        verifying the md5sum doesn't require re-reading the file, and that a partially written file
+        never exists at 'local_abs_path'.
+        """
+        tmp_path = f"{local_abs_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'xb') as fp:
+                writer = _HashingWriter(fp)
+                blob.download_to_file(writer)
+                fp.flush()
+                os.fsync(fp.fileno())
+            local_md5sum = writer.md5sum()
+            self._check_download(record, writer.n_bytes, local_md5sum)
+            os.replace(tmp_path, local_abs_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return _DownloadResult(local_md5sum, writer.hash_time, 0)
+
+    def _download_blob_in_chunks(self, blob, record, local_abs_path, chunk_size, n_chunk_jobs):
+        """Download 'blob' to 'local_abs_path' in byte range chunks and return a _DownloadResult.
+
+        Chunks are downloaded by a pool of 'n_chunk_jobs' threads and written into
+        '{local_abs_path}.partial'. Once a chunk is on disk its index is appended to
+        '{local_abs_path}.partial.chunks', so if the download is interrupted the next call only
+        downloads the missing chunks. The partial file is renamed to 'local_abs_path' once it has
+        been verified.
+        """
+        size = int(record.size)
+        n_chunks = (size + chunk_size - 1) // chunk_size
+        partial_path = f"{local_abs_path}.partial"
+        chunks_path = f"{partial_path}.chunks"
+        # the progress is only valid for the same file downloaded with the same chunk size
+        header = f"{chunk_size}\t{record.size}\t{record.md5sum}"
+        with open(chunks_path, 'a+') as chunks_fp:
+            # only one process can download into the partial file at a time
+            portalocker.lock(chunks_fp, portalocker.LOCK_EX)
+            # another process may have finished the download while we were waiting for the lock
+            if os.path.exists(local_abs_path):
+                start_time = time.time()
+                local_md5sum = self._calc_md5sum(local_abs_path)
+                return _DownloadResult(local_md5sum, time.time() - start_time, size)
+
+            chunks_fp.seek(0)
+            # ignore the last line if it was only partially written
+            lines = chunks_fp.read().split("\n")[:-1]
+            completed_chunks = set()
+            if lines and lines[0] == header and os.path.exists(partial_path):
+                completed_chunks = {int(line) for line in lines[1:]}
+                logger.info(
+                    f"Resuming download of '{record.relative_remote_path}' "
+                    f"({len(completed_chunks)}/{n_chunks} chunks already downloaded).")
+            chunks_fp.seek(0)
+            chunks_fp.truncate()
+            chunks_fp.write(header + "\n")
+            chunks_fp.writelines(f"{chunk_i}\n" for chunk_i in sorted(completed_chunks))
+            chunks_fp.flush()
+
+            # chunks that are downloaded in order are hashed as they are written, and everything
+            # after 'hashed_offset' is read back from disk once all of the chunks are downloaded
+            md5 = hashlib.md5()
+            hashed_offset = 0
+            hash_time = 0.0
+            lock = threading.Lock()
+            with open(partial_path, 'r+b' if completed_chunks else 'w+b') as fp:
+                fp.truncate(size)
+
+                def download_chunk(chunk_i):
+                    nonlocal hashed_offset, hash_time
+                    start = chunk_i*chunk_size
+                    end = min(start + chunk_size, size)
+                    data = blob.download_as_bytes(start=start, end=end - 1)
+                    if len(data) != end - start:
+                        raise FileMismatchError(
+                            f"Received {len(data)} bytes for chunk {chunk_i} of "
+                            f"'{record.relative_remote_path}' (expected {end - start})"
+                        )
+                    os.pwrite(fp.fileno(), data, start)
+                    os.fsync(fp.fileno())
+                    with lock:
+                        if start == hashed_offset:
+                            hash_start_time = time.time()
+                            md5.update(data)
+                            hash_time += time.time() - hash_start_time
+                            hashed_offset = end
+                        chunks_fp.write(f"{chunk_i}\n")
+                        chunks_fp.flush()
+
+                missing_chunks = [i for i in range(n_chunks) if i not in completed_chunks]
+                for _ in _imap_unordered(download_chunk, missing_chunks, n_chunk_jobs):
+                    pass
+
+                hash_start_time = time.time()
+                fp.seek(hashed_offset)
+                for data in iter(lambda: fp.read(MD5_BUFFER_SIZE), b''):
+                    md5.update(data)
+                hash_time += time.time() - hash_start_time
+
+            local_md5sum = digest_to_base64(md5.digest())
+            try:
+                self._check_download(record, os.path.getsize(partial_path), local_md5sum)
+            except FileMismatchError:
+                # the partial file is corrupt, so start from scratch next time
+                os.remove(partial_path)
+                os.remove(chunks_path)
+                raise
+            os.replace(partial_path, local_abs_path)
+            os.remove(chunks_path)
+
+        resumed_bytes = sum(min(chunk_size, size - chunk_i*chunk_size) for chunk_i in completed_chunks)
+        return _DownloadResult(local_md5sum, hash_time, resumed_bytes)
+
+    def get_local_path(self, name, local_prefix=None, chunk_size=None, n_chunk_jobs=1):
+        """Return the local path of record 'name', downloading the file first if necessary.
+
+        If the file already exists then it is verified and its path returned immediately. The
+        md5sum is only checked if there is a checksum cache (so it is only re-calculated when the
+        file's stat signature has changed), otherwise only the file size is checked.
+
+        Downloads happen while holding an exclusive lock on '{local_abs_path}.lock', so concurrent
+        calls from several threads or processes on the same host only download the file once.
+        """
+        record = self[name]
+        local_abs_path = os.path.join(local_prefix or self.local_prefix, record.relative_local_path)
+        check_md5sums = self.checksum_cache is not None
+        if os.path.exists(local_abs_path):
+            self._verify_record(record, local_abs_path, check_md5sums=check_md5sums)
+            if self.local_cache is not None:
+                self.local_cache.touch(local_abs_path, int(record.size))
+            return local_abs_path
+
+        os.makedirs(os.path.dirname(local_abs_path), exist_ok=True)
+        lock_fname = f"{local_abs_path}.lock"
+        with _lock_file(lock_fname, timeout=FETCH_LOCK_TIMEOUT):
+            # another process may have downloaded the file while we were waiting for the lock
+            if os.path.exists(local_abs_path):
+                self._verify_record(record, local_abs_path, check_md5sums=check_md5sums)
+            else:
+                if self.local_cache is not None:
+                    self.local_cache.evict(reserve_bytes=int(record.size))
+                self._download_record(record, local_abs_path, chunk_size, n_chunk_jobs)
+                # anything that acquires the lock after this point will find the downloaded file,
+                # so it is safe to remove the lock file
+                os.remove(lock_fname)
+        if self.local_cache is not None:
+            self.local_cache.touch(local_abs_path, int(record.size))
+        return local_abs_path
+
+    def open_stream(
+            self, name, mode='rb', chunk_size=STREAM_CHUNK_SIZE, n_read_ahead=2, encoding=None):
+        """Open the remote file of record 'name' for reading, without making a local copy.
+
+        The file is read from GCS in 'chunk_size' byte ranges, with 'n_read_ahead' chunks fetched
+        in the background, so at most (n_read_ahead + 1)*chunk_size bytes are held in memory.
+        'mode' is either 'rb' (the default) or 'r' for a text stream with 'encoding'.
+
+        The stream can only be read forwards. Its md5sum is checked once the end of the stream
+        is read, which raises a FileMismatchError if it doesn't match the manifest, so consumers
+        should only trust their results once they have read the whole file.
+        """
+        if mode not in ('rb', 'r', 'rt'):
+            raise ValueError(f"Unsupported mode '{mode}' (expected 'rb' or 'r')")
+        record = self[name]
+        blob = self._get_gcs_blob(record.relative_remote_path)
+        stream = io.BufferedReader(
+            _BlobStream(blob, record, chunk_size, n_read_ahead), buffer_size=chunk_size)
+        if mode == 'rb':
+            return stream
+        return io.TextIOWrapper(stream, encoding=encoding)
+
+    @contextlib.contextmanager
+    def pin(self, names, local_prefix=None):
+        """Fetch the records in 'names' and keep them in the local cache inside of this block.
+
+        Yields a list of the records' local paths. Pinned files are never evicted from the local
+        cache, by this or any other process.
+        """
+        with contextlib.ExitStack() as stack:
+            local_paths = []
+            for name in names:
+                record = self[name]
+                local_abs_path = os.path.join(
+                    local_prefix or self.local_prefix, record.relative_local_path)
+                if self.local_cache is not None:
+                    stack.enter_context(self.local_cache.pin(local_abs_path))
+                local_paths.append(self.get_local_path(name, local_prefix))
+            yield local_paths
+
+    def _sync_state_fname(self, local_prefix):
+        # manifests in different directories can have the same basename
+        fname_hash = hashlib.sha1(os.path.abspath(self.fname).encode('utf8')).hexdigest()[:12]
+        return os.path.join(
+            local_prefix, SYNC_STATE_DIRNAME, f"{os.path.basename(self.fname)}.{fname_hash}")
+
+    def synced_records(self, local_prefix):
+        """Return an OrderedDict of the records that were last synced to 'local_prefix'."""
+        state_fname = self._sync_state_fname(local_prefix)
+        if not os.path.exists(state_fname):
+            return OrderedDict()
+        with open(state_fname) as fp:
+            return _parse_manifest_lines(fp, state_fname)[1]
+
+    def _update_sync_state(self, local_prefix, synced, pruned):
+        """Add the 'synced' records to, and remove the 'pruned' names from, the synced state."""
+        state_fname = self._sync_state_fname(local_prefix)
+        os.makedirs(os.path.dirname(state_fname), exist_ok=True)
+        # re-read the state under the lock so that we don't lose the updates of concurrent syncs
+        with _lock_file(f"{state_fname}.lock"):
+            records = self.synced_records(local_prefix)
+            for name in pruned:
+                records.pop(name, None)
+            for record in synced:
+                records[record.name] = record
+            tmp_fname = f"{state_fname}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_fname, 'w') as fp:
+                    fp.write("\t".join(self.header) + "\n")
+                    fp.writelines("\t".join(record) + "\n" for record in records.values())
+                os.replace(tmp_fname, state_fname)
+            finally:
+                if os.path.exists(tmp_fname):
+                    os.remove(tmp_fname)
+
+    def _prune(self, local_prefix, synced_records):
+        """Remove the local files of synced records that are no longer in the manifest.
+
+        Returns the names of the records that were removed from the manifest.
+        """
+        local_paths = {record.relative_local_path for record in self.values()}
+        pruned = []
+        for name, old_record in synced_records.items():
+            record = self.get(name)
+            if record is None:
+                pruned.append(name)
+            # the old path may still be used, e.g. by a record that was renamed
+            if old_record.relative_local_path in local_paths:
+                continue
+            local_abs_path = os.path.join(local_prefix, old_record.relative_local_path)
+            if os.path.exists(local_abs_path):
+                logger.info(f"Pruning '{local_abs_path}'.")
+                os.remove(local_abs_path)
+            if self.local_cache is not None:
+                self.local_cache.forget(local_abs_path)
+        return pruned
+
+    def sync(
+            self,
+            local_prefix,
+            n_jobs=1,
+            max_bytes_in_flight=None,
+            chunk_size=None,
+            n_chunk_jobs=1,
+            names=None,
+            pattern=None,
+            tag=None,
+            dedupe=False,
+            content_store_dir=None,
+            delta=False,
+            prune=False
+    ):
+        """Sync the remote files to a local path.
+
+        Records are synced by a pool of 'n_jobs' threads. If 'max_bytes_in_flight' is set then
+        new downloads wait until the total size of the files being downloaded is below it.
+
+        If 'chunk_size' is set then files larger than it are downloaded in resumable byte range
+        chunks, 'n_chunk_jobs' chunks of each file at a time.
+
+        'names', 'pattern' and 'tag' restrict the sync to the selected records (see select).
+
+        If 'dedupe' is True then files are downloaded into a content addressed store in
+        'content_store_dir' (by default '{local_prefix}/.content-store'), and the local paths are
+        hard links to the stored files. Files with the same md5sum are only downloaded once, and
+        are only stored once if several manifests share the same store. Local files that already
+        match the manifest are added to the store rather than downloaded again. The store can also be on
+        a file system that is shared by several hosts, in which case each file is downloaded by
+        one host while the others wait for it and then copy it (or hard link it, if the local
+        prefix is on the same file system) from the store.
+
+        The records that were synced are stored in '{local_prefix}/.sync-state/'. If 'delta' is
+        True then only records that were added or changed since the last sync are synced, and
+        unchanged files are not checked at all (so a full sync is needed to repair files that were
+        modified or removed by something else). Local files of records that changed are replaced.
+        If 'prune' is True then the local files of records that were removed from the manifest
+        (or moved to another local path) are removed.
+
+        If the manifest has a local cache then the least recently used files are evicted before
+        each download to make room for it, but files of the records selected by this sync are
+        never evicted. Delta syncs also re-sync records whose files were evicted. A local cache
+        can't be combined with 'dedupe', because evicting a hard link doesn't free the stored file.
+
+        A 'sync_summary' event is emitted at the end of the sync, even if it fails.
+        """
+        if dedupe and self.local_cache is not None:
+            raise ValueError(
+                "A local cache can't be used with dedupe, because evicting a linked file doesn't "
+                "remove it from the content store"
+            )
+        start_time = time.time()
+        byte_budget = _ByteBudget(max_bytes_in_flight)
+        selected = self.select(names, pattern, tag)
+        records = selected
+        synced_records = self.synced_records(local_prefix)
+        if delta:
+            # files can be evicted from the local cache after they were synced
+            check_exists = self.local_cache is not None
+            records = [
+                record for record in records
+                if _sync_key(record) != _sync_key(synced_records.get(record.name))
+                or (check_exists
+                    and not os.path.exists(os.path.join(local_prefix, record.relative_local_path)))
+            ]
+            logger.info(f"Syncing {len(records)} records that changed since the last sync.")
+
+        # we synced the old versions of changed files, so it is safe to replace them
+        for record in records:
+            old_record = synced_records.get(record.name)
+            if old_record is None or old_record.md5sum == record.md5sum:
+                continue
+            old_abs_path = os.path.join(local_prefix, old_record.relative_local_path)
+            if old_record.relative_local_path == record.relative_local_path \
+                    and os.path.exists(old_abs_path):
+                logger.info(f"Removing the outdated version of '{old_abs_path}'.")
+                os.remove(old_abs_path)
+
+        pruned = self._prune(local_prefix, synced_records) if prune else []
+        total_bytes = sum(int(record.size) for record in records)
+        n_synced, synced_bytes = 0, 0
+
+        if dedupe:
+            # group the records by md5sum so that each unique file is downloaded once
+            store = _ContentStore(
+                content_store_dir or os.path.join(local_prefix, DEFAULT_CONTENT_STORE_DIRNAME))
+            groups = defaultdict(list)
+            for record in records:
+                groups[record.md5sum].append(record)
+            groups = [tuple(group) for group in groups.values()]
         else:
-            # copy the file to local_path
-            logger.info(f"Copying '{record.remote_path}' to '{local_abs_path}'.")
-            blob = self._get_gcs_blob(record.remote_path)
-            # make sure the directory exists
-            dirname = os.path.dirname(local_abs_path)
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
-            blob.download_to_filename(local_abs_path)
-            assert os.path.getsize(local_abs_path) == int(record.size), "{}, {}".format(
-                os.path.getsize(local_abs_path), record.size
+            groups = [(record,) for record in records]
+
+        if self.local_cache is not None:
+            keep = frozenset(
+                os.path.abspath(os.path.join(local_prefix, record.relative_local_path))
+                for record in selected
             )
-            # skip this assert because it is slow (and filesize should catch anything weird)
-            # assert calc_md5sum(local_path) == local_md5sum
+            evict_lock = threading.Lock()
 
-    def sync(self, local_prefix):
-        """Sync the remote files to a local path."""
-        for record in self.values():
-            local_abs_path = os.path.join(local_prefix, record.local_path)
-            self._sync_record(record, local_abs_path)
+        def sync_group(group):
+            if dedupe:
+                return self._sync_records_via_store(
+                    group, local_prefix, store, byte_budget, chunk_size, n_chunk_jobs)
+            local_abs_path = os.path.join(local_prefix, group[0].relative_local_path)
+            if self.local_cache is not None and not os.path.exists(local_abs_path):
+                # make room for the download before it starts, and track the file straight away so
+                # that the downloads that are in flight count towards the cache's budget
+                with evict_lock:
+                    self.local_cache.evict(reserve_bytes=int(group[0].size), keep=keep)
+                    self.local_cache.touch(local_abs_path, int(group[0].size))
+            return self._sync_record(group[0], local_abs_path, byte_budget, chunk_size, n_chunk_jobs)
 
-    def verify(self, local_prefix, check_md5sums=False):
+        synced = []
+        summary = TransferSummary()
+        completed = False
+        try:
+            for group, event in _imap_unordered(sync_group, groups, n_jobs):
+                synced.extend(group)
+                summary.add(len(group), sum(int(record.size) for record in group), event)
+                n_synced += len(group)
+                synced_bytes += sum(int(record.size) for record in group)
+                logger.info(
+                    f"Synced {n_synced}/{len(records)} records "
+                    f"({synced_bytes}/{total_bytes} bytes) to '{local_prefix}'."
+                )
+                if self.local_cache is not None:
+                    for record in group:
+                        self.local_cache.touch(
+                            os.path.join(local_prefix, record.relative_local_path), int(record.size))
+            completed = True
+        finally:
+            # record whatever was synced, so that a delta sync can pick up where this one failed
+            self._update_sync_state(local_prefix, synced, pruned)
+            self._emit(
+                'sync_summary', local_prefix=local_prefix, completed=completed,
+                n_selected=len(records), n_pruned=len(pruned),
+                **summary.fields(time.time() - start_time)
+            )
+
+    def verify_sizes(self, local_prefix, n_jobs=8, names=None, pattern=None, tag=None):
+        """Check that the files at 'local_prefix' exist and have the sizes in the manifest.
+
+        This is much faster than verify on file systems where each stat is slow (e.g. NFS or
+        GCSFuse mounts). Each directory is listed once with os.scandir, rather than checking
+        whether each file exists, and the directories are listed and the files are stat'd by a
+        pool of 'n_jobs' threads. Every selected record (see select) is checked, and the
+        VerifyReport with all of the missing and mismatched files is returned.
+        """
+        start_time = time.time()
+        report = VerifyReport(local_prefix)
+        records_by_dir = defaultdict(list)
+        for record in self.select(names, pattern, tag):
+            local_abs_path = os.path.normpath(os.path.join(local_prefix, record.relative_local_path))
+            records_by_dir[os.path.dirname(local_abs_path)].append((record, local_abs_path))
+            report.n_records += 1
+            report.n_bytes += int(record.size)
+
+        def scan_dir(dirname):
+            try:
+                with os.scandir(dirname) as entries:
+                    return {entry.name: entry for entry in entries}
+            except (FileNotFoundError, NotADirectoryError):
+                return {}
+
+        # stat the files in batches, so that large directories are also checked in parallel
+        batches = []
+        for dirname, entries in _imap_unordered(scan_dir, list(records_by_dir), n_jobs):
+            dir_records = [
+                (record, local_abs_path, entries.get(os.path.basename(local_abs_path)))
+                for record, local_abs_path in records_by_dir[dirname]
+            ]
+            for i in range(0, len(dir_records), STAT_BATCH_SIZE):
+                batches.append(tuple(dir_records[i:i + STAT_BATCH_SIZE]))
+
+        def check_batch(batch):
+            failures = []
+            for record, local_abs_path, entry in batch:
+                record_start_time = time.time()
+                try:
+                    if entry is None or not entry.is_file():
+                        raise FileNotFoundError(local_abs_path)
+                    local_fsize = entry.stat().st_size
+                except FileNotFoundError:
+                    failures.append(VerifyFailure(
+                        record.name, local_abs_path, 'missing',
+                        f"Can not find '{record.name}' at '{local_abs_path}'",
+                        time.time() - record_start_time
+                    ))
+                    continue
+                if local_fsize != int(record.size):
+                    failures.append(VerifyFailure(
+                        record.name, local_abs_path, 'size',
+                        f"'{local_abs_path}' has size '{local_fsize}' vs '{record.size}' "
+                        f"in the manifest",
+                        time.time() - record_start_time
+                    ))
+            return failures
+
+        for _, failures in _imap_unordered(check_batch, batches, n_jobs):
+            report.failures.extend(failures)
+        report.failures.sort(key=lambda failure: failure.path)
+        report.duration = time.time() - start_time
+
+        for failure in report.failures:
+            logger.error(failure.message)
+        logger.info(
+            f"Checked the sizes of {report.n_records} records in '{local_prefix}' in "
+            f"{report.duration:.1f}s ({len(report.failures)} failures)."
+        )
+        self._emit(
+            'verify_summary', local_prefix=local_prefix, completed=True,
+            n_selected=report.n_records, check_md5sums=False, stat_only=True,
+            n_records=report.n_records, bytes=report.n_bytes, n_failures=len(report.failures),
+            duration=report.duration
+        )
+        return report
+
+    def verify(
+            self,
+            local_prefix,
+            check_md5sums=False,
+            n_jobs=1,
+            force=False,
+            names=None,
+            pattern=None,
+            tag=None,
+            report=False
+    ):
         """Ensure that the files at 'local_prefix' match the manifest.
 
-        If 'slow' is True, then additionally ensure that the md5sum's match.
+        If 'check_md5sums' is True, then additionally ensure that the md5sum's match. Records are
+        verified by a pool of 'n_jobs' threads, so md5sums can be calculated on several cores. If
+        'force' is True then md5sums are re-calculated even if they are in the checksum cache.
+
+        'names', 'pattern' and 'tag' restrict the verification to the selected records (see
+        select). A 'verify_summary' event is emitted at the end of the verification, even if it
+        fails.
+
+        By default the first file that doesn't match raises a MissingFileError or
+        FileMismatchError. If 'report' is True then every record is checked, and a VerifyReport
+        with all of the missing and mismatched files is returned instead.
         """
-        for record in self.values():
-            local_abs_path = os.path.join(local_prefix, record.local_path)
-            self._verify_record(record, local_abs_path, check_md5sums=check_md5sums)
+        def verify_record(record):
+            local_abs_path = os.path.join(local_prefix, record.relative_local_path)
+            if report:
+                return self._check_record(record, local_abs_path, check_md5sums, force)
+            return None, self._verify_record(record, local_abs_path, check_md5sums, force)
+
+        start_time = time.time()
+        records = self.select(names, pattern, tag)
+        verify_report = VerifyReport(local_prefix, check_md5sums)
+        summary = TransferSummary()
+        completed = False
+        try:
+            for record, (failure, event) in _imap_unordered(verify_record, records, n_jobs):
+                summary.add(1, int(record.size), event)
+                if failure is not None:
+                    logger.error(failure.message)
+                    verify_report.failures.append(failure)
+            completed = True
+        finally:
+            self._emit(
+                'verify_summary', local_prefix=local_prefix, completed=completed,
+                n_selected=len(records), check_md5sums=check_md5sums,
+                n_failures=len(verify_report.failures), **summary.fields(time.time() - start_time)
+            )
+
+        if report:
+            verify_report.failures.sort(key=lambda failure: failure.path)
+            verify_report.n_records = summary.n_records
+            verify_report.n_bytes = summary.n_bytes
+            verify_report.hash_time = summary.hash_time
+            verify_report.duration = time.time() - start_time
+            return verify_report
 
 
 class DataManifestWriter(_DataManifestBase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._in_transaction = False
+
     def _save_to_disk(self):
         """Save the current data to disk."""
-        with portalocker.Lock(self.fname, "r+") as fp:
+        # writes are deferred until the end of a transaction
+        if self._in_transaction:
+            return
+
+        data = "\t".join(self.header) + "\n"
+        data += "".join("\t".join(record) + "\n" for record in self.values())
+        # writers hold a lock on a separate lock file because the manifest itself is replaced
+        with _lock_file(self.lock_fname, shared=False):
             # first make sure that the manifest hasn't changed since we last read it
-            on_disk_md5sum = calc_md5sum_from_fp(fp)
-            if on_disk_md5sum != self._md5sum:
-                raise RuntimeError(
-                    f"'{self.fname}' was modified by another program (current md5sum "
-                    f"'{on_disk_md5sum}' vs '{self._md5sum}')"
-                )
+            if self.is_stale():
+                with open(self.fname) as fp:
+                    on_disk_md5sum = calc_md5sum_from_fp(fp)
+                if on_disk_md5sum != self._md5sum:
+                    raise RuntimeError(
+                        f"'{self.fname}' was modified by another program (current md5sum "
+                        f"'{on_disk_md5sum}' vs '{self._md5sum}')"
+                    )
+
+            # write the new manifest to a temporary file and then atomically replace the old one,
+            # so that readers see either the old or the new manifest
+            tmp_fname = f"{self.fname}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_fname, "w") as fp:
+                    fp.write(data)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                    generation = stat_signature(fp.fileno())
+                shutil.copymode(self.fname, tmp_fname)
+                os.replace(tmp_fname, self.fname)
+            finally:
+                if os.path.exists(tmp_fname):
+                    os.remove(tmp_fname)
+            _fsync_dir(os.path.dirname(os.path.abspath(self.fname)))
 
-            # truncate the file, and re-write it
-            fp.seek(0)
-            fp.truncate()
-            fp.write("\t".join(self.header) + "\n")
-            for record in self.values():
-                fp.write("\t".join(record) + "\n")
-            fp.flush()
+        # update the md5sum and generation
+        self._md5sum = digest_to_base64(hashlib.md5(data.encode('utf8')).digest())
+        self.generation = generation
 
-            # update the md5sum
-            self._md5sum = calc_md5sum_from_fp(fp)
-            fp.close()
+    @contextlib.contextmanager
+    def transaction(self):
+        """Write all of the changes made in this block to disk at once.
+
+        If the block raises an exception then the changes are discarded (files that were already
+        uploaded to GCS are left there). Nested transactions are part of the outermost one.
+        """
+        if self._in_transaction:
+            yield self
+            return
+        records = list(self.values())
+        self._in_transaction = True
+        try:
+            yield self
+        except BaseException:
+            self.clear()
+            self.update((record.name, record) for record in records)
+            raise
+        finally:
+            self._in_transaction = False
+        self._save_to_disk()
 
     def remove_file(self, name):
         """Remove a file from the manifest.
@@ -202,29 +1624,103 @@ class DataManifestWriter(_DataManifestBase):
         del self[name]
         self._save_to_disk()
 
-    def add_file(
+    def _upload_in_parts(self, fname, blob, part_size, n_jobs):
+        """Upload 'fname' to 'blob' in parallel parts, and return its md5sum and the hashing time.
+
+        The file is read once, in order, and each 'part_size' part is hashed and then uploaded to a
+        temporary blob by a pool of 'n_jobs' threads. The parts are then composed into 'blob'. GCS
+        doesn't calculate md5sums for composite objects, so the md5sum that was calculated locally
+        is stored in the blob's metadata, and the crc32c that GCS does calculate is checked against
+        a crc32c that was calculated in the same pass.
+        """
+        md5 = hashlib.md5()
+        crc32c = google_crc32c.Checksum()
+        hash_time = 0.0
+        # all of the part and intermediate blobs, which are deleted once the upload is finished
+        tmp_blobs = []
+        # limit the number of parts that are in memory at once
+        parts_in_memory = threading.BoundedSemaphore(n_jobs + 1)
+        try:
+            with open(fname, 'rb') as fp, ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                futures = []
+                while True:
+                    parts_in_memory.acquire()
+                    # stop reading if one of the uploads has already failed
+                    for future in futures:
+                        if future.done():
+                            future.result()
+                    data = fp.read(part_size)
+                    if not data:
+                        parts_in_memory.release()
+                        break
+                    hash_start_time = time.time()
+                    md5.update(data)
+                    crc32c.update(data)
+                    hash_time += time.time() - hash_start_time
+                    part_blob = blob.bucket.blob(f"{blob.name}.part-{len(tmp_blobs):05d}")
+                    tmp_blobs.append(part_blob)
+                    future = executor.submit(part_blob.upload_from_string, data)
+                    future.add_done_callback(lambda _: parts_in_memory.release())
+                    futures.append(future)
+                    del data
+                for future in futures:
+                    future.result()
+
+            # GCS can compose at most 32 blobs at once, so compose large files in several rounds
+            part_blobs = list(tmp_blobs)
+            compose_round = 0
+            while len(part_blobs) > GCS_MAX_COMPOSE_SOURCES:
+                composed_blobs = []
+                for i in range(0, len(part_blobs), GCS_MAX_COMPOSE_SOURCES):
+                    composed_blob = blob.bucket.blob(
+                        f"{blob.name}.compose-{compose_round}-{len(composed_blobs):05d}")
+                    tmp_blobs.append(composed_blob)
+                    composed_blob.compose(part_blobs[i:i + GCS_MAX_COMPOSE_SOURCES])
+                    composed_blobs.append(composed_blob)
+                part_blobs = composed_blobs
+                compose_round += 1
+
+            local_md5sum = digest_to_base64(md5.digest())
+            blob.metadata = dict(blob.metadata or {}, md5sum=local_md5sum)
+            blob.compose(part_blobs)
+        finally:
+            self._delete_blobs(tmp_blobs, n_jobs)
+
+        local_crc32c = digest_to_base64(crc32c.digest())
+        if blob.crc32c != local_crc32c:
+            raise FileMismatchError(
+                f"Uploaded '{blob.name}' has crc32c '{blob.crc32c}' vs '{local_crc32c}' "
+                f"for '{fname}'"
+            )
+        return local_md5sum, hash_time
+
+    @staticmethod
+    def _delete_blobs(blobs, n_jobs):
+        def delete_blob(blob):
+            try:
+                blob.delete()
+            except NotFound:
+                pass
+
+        for _ in _imap_unordered(delete_blob, blobs, n_jobs):
+            pass
+
+    def _upload_file(
             self,
             name,
             fname,
             local_relative_path,
             remote_relative_path,
-            note=''
+            note='',
+            part_size=None,
+            n_jobs=1
     ):
-        """Add a file to the manifest.
-
-        Add a file to the manifest and upload the file to GCS.
-        """
-        if name in self:
-            raise KeyAlreadyExistsError("'{record.name}' is duplicated in '{self.fname}'")
-
+        """Upload 'fname' to GCS (if it isn't there already) and return its manifest record."""
         # make sure that we can open the file that we want to add for reading
         with open(fname) as _: # noqa
             pass
 
-        # find the file's file size and calculate the checksum
-        logger.info(f"Calculating md5sum for '{fname}'")
-        local_md5sum = calc_md5sum_from_fname(fname)
-        logger.debug(f"Calculated md5sum '{local_md5sum}' for '{fname}'.")
+        start_time = time.time()
         local_fsize = os.path.getsize(fname)
         logger.debug(f"Calculated filesize '{local_fsize}' for '{fname}'.")
 
@@ -232,70 +1728,575 @@ class DataManifestWriter(_DataManifestBase):
         blob = self._get_gcs_blob(remote_relative_path)
         try:
             blob.reload()
+        # if we can't find the file, upload it
+        except NotFound:
+            logger.info(f"Uploading '{fname}' to '{self.remote_prefix}{remote_relative_path}'")
+            uploaded = True
+            if part_size is not None and local_fsize > part_size:
+                # the md5sum is calculated while the file is uploaded
+                local_md5sum, hash_time = self._upload_in_parts(fname, blob, part_size, n_jobs)
+            else:
+                logger.info(f"Calculating md5sum for '{fname}'")
+                hash_start_time = time.time()
+                local_md5sum = self._calc_md5sum(fname)
+                hash_time = time.time() - hash_start_time
+                blob.upload_from_filename(fname)
+            logger.debug(f"Calculated md5sum '{local_md5sum}' for '{fname}'.")
+            assert blob.size == local_fsize, \
+                "We just uploaded this file so the filesizes should match"
+            assert get_blob_md5sum(blob) == local_md5sum, \
+                f"We just uploaded this file so the md5sums should match " \
+                f"('{get_blob_md5sum(blob)}' vs '{local_md5sum}')"
+        else:
             # if it exists, make sure that it is the same as the local file
-            if local_md5sum != blob.md5_hash:
+            uploaded = False
+            logger.info(f"Calculating md5sum for '{fname}'")
+            hash_start_time = time.time()
+            local_md5sum = self._calc_md5sum(fname)
+            hash_time = time.time() - hash_start_time
+            logger.debug(f"Calculated md5sum '{local_md5sum}' for '{fname}'.")
+            if local_md5sum != get_blob_md5sum(blob):
                 raise FileAlreadyExistsError(
                     f"File '{self.remote_prefix}{remote_relative_path}' already exists with md5sum"
-                    f"'{blob.md5_hash}' vs '{local_md5sum}' for '{fname}')"
+                    f"'{get_blob_md5sum(blob)}' vs '{local_md5sum}' for '{fname}')"
                 )
             if local_fsize != blob.size:
                 raise FileAlreadyExistsError(
                     f"File '{self.remote_prefix}{remote_relative_path}' already exists with file "
                     f"size '{blob.size}' vs '{local_fsize}' for '{fname}')"
                 )
-        # if we can't find the file, upload it
-        except NotFound:
-            logger.info(f"Uploading '{fname}' to '{self.remote_prefix}{remote_relative_path}'")
-            blob.upload_from_filename(fname)
-            assert blob.size == local_fsize, \
-                "We just uploaded this file so the filesizes should match"
-            assert blob.md5_hash == local_md5sum, \
-                f"We just uploaded this file so the md5sums should match " \
-                f"('{blob.md5_hash}' vs '{local_md5sum}')"
-        assert blob.md5_hash is not None
+        assert get_blob_md5sum(blob) is not None
         assert blob.size is not None
 
-        self[name] = DataManifestRecord(
+        duration = time.time() - start_time
+        self._emit(
+            'upload', name=name, path=fname, bytes=local_fsize, duration=duration,
+            transfer_time=duration - hash_time, hash_time=hash_time,
+            throughput=throughput(local_fsize, duration), uploaded=uploaded
+        )
+        return DataManifestRecord(
             name, local_relative_path, remote_relative_path, local_md5sum, str(local_fsize), note
         )
+
+    def add_file(
+            self,
+            name,
+            fname,
+            local_relative_path,
+            remote_relative_path,
+            note='',
+            part_size=None,
+            n_jobs=1
+    ):
+        """Add a file to the manifest.
+
+        Add a file to the manifest and upload the file to GCS. If 'part_size' is set then files
+        larger than it are uploaded in parts, 'n_jobs' parts at a time (see _upload_in_parts).
+        """
+        if name in self:
+            raise KeyAlreadyExistsError(f"'{name}' is duplicated in '{self.fname}'")
+
+        self[name] = self._upload_file(
+            name, fname, local_relative_path, remote_relative_path, note, part_size, n_jobs)
         self._save_to_disk()
 
+    def add_files(self, files, n_jobs=1, part_size=None, n_part_jobs=1):
+        """Add many files to the manifest, and write the manifest once.
 
-def parse_args():
-    # add data file
-    # remove data file
-    # replace data file
-    pass
+        'files' is a list of tuples of add_file arguments, i.e. '(name, fname, local_relative_path,
+        remote_relative_path[, note])'. The files are hashed and uploaded by a pool of 'n_jobs'
+        threads. Records are only added to the manifest once every file has been uploaded, and are
+        added in the order that they appear in 'files'.
+        """
+        files = [tuple(args) for args in files]
+        name_counts = Counter(args[0] for args in files)
+        for name, count in name_counts.items():
+            if name in self or count > 1:
+                raise KeyAlreadyExistsError(f"'{name}' is duplicated in '{self.fname}'")
+
+        def upload_file(args):
+            return self._upload_file(*args, part_size=part_size, n_jobs=n_part_jobs)
 
+        records = dict(_imap_unordered(upload_file, files, n_jobs))
+        with self.transaction():
+            for args in files:
+                self[args[0]] = records[args]
 
-def main(fname):
-    with open(fname) as ifp:
-        for i, line in enumerate(ifp):
-            if i == 0:
-                print(line.strip("\n"))
+
+def _read_legacy_manifest(legacy_fname):
+    """Yield (name, old local path, remote path, notes) for each record in a legacy manifest."""
+    with open(legacy_fname) as fp:
+        for line_i, line in enumerate(fp):
+            # skip the header and empty lines
+            if line_i == 0 or line.strip() == '':
                 continue
             data = line.strip("\n").split("\t")
-            # add space for the md5sum, filesize, and last update time
-            data.insert(-1, None)
-            data.insert(-1, None)
-            data.insert(-1, None)
-
-            data[-1] += "#old path: {}".format(data[1])
-            # update to use the new path
-            local_filename = data[2].replace("gs://balrog/", "/srv/")
-            data[1] = local_filename
-            # calculate the md5sum
-            md5sum = subprocess.run(
-                ["md5sum", data[1]],
-                stdout=subprocess.PIPE
-            ).stdout.split()[0].decode('UTF8')
-            data[-4] = md5sum
-            file_size = str(os.path.getsize(local_filename))
-            data[-3] = file_size
-            last_mtime = str(int(os.path.getmtime(local_filename)))
-            data[-2] = last_mtime
-            print("\t".join(data))
-    return
-
-# if __name__ == '__main__':
-#     main(sys.argv[1])
+            if len(data) < 3:
+                raise ValueError(
+                    f"Line {line_i + 1} of '{legacy_fname}' has {len(data)} columns (expected "
+                    f"the name, old path, remote path and notes)"
+                )
+            yield data[0], data[1], data[2], data[3] if len(data) > 3 else ''
+
+
+def _read_partial_manifest(partial_fname):
+    """Return the records in a partially written manifest, ignoring a partially written line."""
+    if not os.path.exists(partial_fname):
+        return OrderedDict()
+    with open(partial_fname) as fp:
+        lines = fp.read().split("\n")
+    # the last element is either '' or a line that was cut off
+    return _parse_manifest_lines(lines[:-1], partial_fname)[1]
+
+
+def migrate_legacy_manifest(
+        legacy_fname,
+        output_fname,
+        remote_prefix=DEFAULT_REMOTE_PREFIX,
+        local_prefix=None,
+        path_mapping=LEGACY_PATH_MAPPING,
+        n_jobs=1,
+        checksum_cache=None
+):
+    """Convert a legacy manifest into a data manifest, and return the records.
+
+    Legacy manifests have (name, old path, remote path, notes) columns. The local copy of each
+    file is found by replacing the 'path_mapping' prefix of its remote path (e.g. 'gs://balrog/'
+    with '/srv/'), and is hashed (by a pool of 'n_jobs' threads) to build its record. The local
+    and remote paths are made relative to 'local_prefix' (by default 'remote_prefix' with the
+    path mapping applied) and 'remote_prefix'. The old path is kept in the notes.
+
+    'checksum_cache' is either a ChecksumCache or the filename of one to open. Records are also
+    appended to '{output_fname}.partial' as they are hashed, so an interrupted migration resumes
+    where it stopped. Records whose local files are missing are reported in a MissingFileError
+    once every other record has been migrated.
+    """
+    old_prefix, new_prefix = path_mapping
+    if local_prefix is None:
+        local_prefix = remote_prefix.replace(old_prefix, new_prefix, 1)
+    if isinstance(checksum_cache, str):
+        checksum_cache = ChecksumCache(checksum_cache)
+
+    records = OrderedDict()
+    for name, old_path, remote_path, notes in _read_legacy_manifest(legacy_fname):
+        if name in records:
+            raise KeyAlreadyExistsError(f"'{name}' is duplicated in '{legacy_fname}'")
+        if not remote_path.startswith(remote_prefix) or not remote_path.startswith(old_prefix):
+            raise ValueError(
+                f"The remote path '{remote_path}' of '{name}' isn't under '{remote_prefix}' "
+                f"and '{old_prefix}'"
+            )
+        local_abs_path = new_prefix + remote_path[len(old_prefix):]
+        relative_local_path = os.path.relpath(local_abs_path, local_prefix)
+        if relative_local_path.startswith(os.pardir):
+            raise ValueError(f"'{local_abs_path}' of '{name}' isn't under '{local_prefix}'")
+        notes = f"{notes} old_path:{old_path}".strip()
+        records[name] = (
+            local_abs_path,
+            DataManifestRecord(
+                name, relative_local_path, remote_path[len(remote_prefix):], None, None, notes)
+        )
+
+    def is_done(name, old_record):
+        local_abs_path, record = records[name]
+        # the file may have been replaced since it was hashed
+        return (
+            old_record._replace(md5sum=None, size=None) == record
+            and os.path.exists(local_abs_path)
+            and old_record.size == str(os.path.getsize(local_abs_path))
+        )
+
+    partial_fname = f"{output_fname}.partial"
+    done = OrderedDict(
+        (name, old_record) for name, old_record in _read_partial_manifest(partial_fname).items()
+        if name in records and is_done(name, old_record)
+    )
+    if done:
+        logger.info(f"Resuming the migration of '{legacy_fname}' ({len(done)} records done).")
+
+    def migrate_record(name):
+        local_abs_path, record = records[name]
+        local_fsize = os.path.getsize(local_abs_path)
+        md5sum = _calc_cached_md5sum(local_abs_path, checksum_cache)
+        return record._replace(md5sum=md5sum, size=str(local_fsize))
+
+    missing = [
+        name for name, (local_abs_path, _) in records.items() if not os.path.exists(local_abs_path)]
+    pending = [name for name in records if name not in done and name not in missing]
+    # rewrite the partial file, which drops stale records and any partially written line
+    with open(partial_fname, 'w') as ofp:
+        ofp.write("\t".join(DataManifestRecord._fields) + "\n")
+        ofp.writelines("\t".join(record) + "\n" for record in done.values())
+        ofp.flush()
+        for n_hashed, (name, record) in enumerate(
+                _imap_unordered(migrate_record, pending, n_jobs), 1):
+            done[name] = record
+            ofp.write("\t".join(record) + "\n")
+            ofp.flush()
+            if n_hashed % 1000 == 0:
+                logger.info(f"Hashed {n_hashed}/{len(pending)} files for '{output_fname}'.")
+
+    if missing:
+        raise MissingFileError("\n".join(
+            f"Can not find '{name}' at '{records[name][0]}'" for name in missing))
+
+    # write the records in the legacy order
+    tmp_fname = f"{output_fname}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_fname, 'w') as ofp:
+            ofp.write("\t".join(DataManifestRecord._fields) + "\n")
+            ofp.writelines("\t".join(done[name]) + "\n" for name in records)
+        os.replace(tmp_fname, output_fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+    os.remove(partial_fname)
+    logger.info(f"Migrated {len(records)} records from '{legacy_fname}' to '{output_fname}'.")
+    return [done[name] for name in records]
+
+
+def _add_common_data_arguments(parser, jobs_help, events=True):
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1, help=f'{jobs_help} Default: %(default)s')
+    parser.add_argument(
+        '--checksum-cache', default=None,
+        help='A SQLite database of the md5sums of local files, so that files are only re-hashed '
+             'when they change.'
+    )
+    if not events:
+        return
+    parser.add_argument(
+        '--events', default=None,
+        help='Append a JSON line for every transfer and a summary to this file.'
+    )
+
+
+def _add_selection_arguments(parser):
+    parser.add_argument(
+        '--only', action='append', default=None, metavar='NAME',
+        help='Only use the record with this name (can be given more than once).'
+    )
+    parser.add_argument(
+        '--pattern', default=None,
+        help='Only use the records whose local paths match this glob.'
+    )
+    parser.add_argument(
+        '--tag', default=None,
+        help="Only use the records with this tag in their notes (e.g. 'tags=hg38,fasta')."
+    )
+
+
+def add_data_subparser(subparsers):
+    data_parser = subparsers.add_parser(
+        'data', help='manage the data files that are tracked by a data manifest')
+    data_parser.required = True
+    data_parser.add_argument(
+        '--manifest', default=DEFAULT_MANIFEST_FNAME,
+        help='The data manifest. Default: %(default)s'
+    )
+    data_parser.add_argument(
+        '--local-prefix', default=None,
+        help=f'The directory that the local paths are relative to. Default: {DEFAULT_LOCAL_PREFIX} '
+             f'(for migrate, the remote prefix with the legacy path mapping applied)'
+    )
+    data_parser.add_argument(
+        '--remote-prefix', default=DEFAULT_REMOTE_PREFIX,
+        help='The GCS prefix that the remote paths are relative to. Default: %(default)s'
+    )
+
+    # add the subparsers
+    data_subparsers = data_parser.add_subparsers(dest='data_command')
+    data_subparsers.required = True
+
+    # Sync the remote files
+    sync_parser = data_subparsers.add_parser(
+        'sync', help='download the files in the manifest to the local prefix')
+    _add_common_data_arguments(sync_parser, 'The number of files to download at once.')
+    _add_selection_arguments(sync_parser)
+    sync_parser.add_argument(
+        '--max-bytes-in-flight', type=int, default=None,
+        help='The maximum number of bytes to download at once. Default: no limit'
+    )
+    sync_parser.add_argument(
+        '--chunk-size', type=int, default=None,
+        help='Download files larger than this many bytes in resumable chunks.'
+    )
+    sync_parser.add_argument(
+        '--chunk-jobs', type=int, default=1,
+        help='The number of chunks of each file to download at once. Default: %(default)s'
+    )
+    sync_parser.add_argument(
+        '--dedupe', action='store_true', default=False,
+        help='Download each unique file once into a content store, and hard link to it.'
+    )
+    sync_parser.add_argument(
+        '--content-store-dir', default=None,
+        help='The content store to use with --dedupe (which can be on a shared file system). '
+             'Default: $LOCAL_PREFIX/.content-store'
+    )
+    sync_parser.add_argument(
+        '--delta', action='store_true', default=False,
+        help='Only sync the records that changed since the last sync.'
+    )
+    sync_parser.add_argument(
+        '--prune', action='store_true', default=False,
+        help='Remove the local files of records that were removed from the manifest.'
+    )
+
+    # Verify the local files
+    verify_parser = data_subparsers.add_parser(
+        'verify', help='check every local file against the manifest and report all failures')
+    _add_common_data_arguments(verify_parser, 'The number of files to verify at once.')
+    _add_selection_arguments(verify_parser)
+    verify_mode_group = verify_parser.add_mutually_exclusive_group()
+    verify_mode_group.add_argument(
+        '--check-md5sums', action='store_true', default=False,
+        help='Also check the md5sums of the local files (slow).'
+    )
+    verify_mode_group.add_argument(
+        '--force', action='store_true', default=False,
+        help='Check the md5sums of the local files, re-calculating them even if they are in the '
+             'checksum cache.'
+    )
+    verify_mode_group.add_argument(
+        '--stat-only', action='store_true', default=False,
+        help='Only check that the files exist and have the right sizes, listing each directory '
+             'once (fast on network file systems).'
+    )
+    verify_parser.add_argument(
+        '--json', action='store_true', default=False,
+        help='Print the report as JSON.'
+    )
+
+    # Add a file
+    add_parser = data_subparsers.add_parser(
+        'add', help='upload a file to GCS and add it to the manifest')
+    _add_common_data_arguments(add_parser, 'The number of parts to upload at once.')
+    add_parser.add_argument('name', help='The name of the record.')
+    add_parser.add_argument('fname', help='The file to add.')
+    add_parser.add_argument(
+        'local_relative_path', help='The path of the file relative to the local prefix.')
+    add_parser.add_argument(
+        'remote_relative_path', help='The path of the file relative to the remote prefix.')
+    add_parser.add_argument(
+        '--note', default='',
+        help="The notes for the record, including any tags (e.g. 'GRCh38 tags=hg38,fasta')."
+    )
+    add_parser.add_argument(
+        '--part-size', type=int, default=None,
+        help='Upload files larger than this many bytes in parallel parts.'
+    )
+
+    # Remove records
+    remove_parser = data_subparsers.add_parser(
+        'remove', help='remove records from the manifest (the files are not deleted)')
+    remove_parser.add_argument('names', nargs='+', help='The names of the records to remove.')
+
+    # Diff two versions of the manifest
+    diff_parser = data_subparsers.add_parser(
+        'diff', help='show the records that were added, removed or changed in the manifest')
+    diff_parser.add_argument(
+        'old', nargs='?', default=None,
+        help='The git revision of the old manifest. Default: HEAD'
+    )
+    diff_parser.add_argument(
+        'new', nargs='?', default=None,
+        help='The git revision of the new manifest. Default: the manifest in the working tree'
+    )
+    diff_parser.add_argument(
+        '--old-file', default=None, help='Use this manifest file as the old manifest.')
+    diff_parser.add_argument(
+        '--new-file', default=None, help='Use this manifest file as the new manifest.')
+    diff_parser.add_argument(
+        '--json', action='store_true', default=False, help='Print the diff as JSON.')
+
+    # Migrate a legacy manifest
+    migrate_parser = data_subparsers.add_parser(
+        'migrate', help='convert a legacy manifest into a data manifest (written to --manifest)')
+    _add_common_data_arguments(migrate_parser, 'The number of files to hash at once.', events=False)
+    migrate_parser.add_argument('legacy_manifest', help='The legacy manifest to convert.')
+    migrate_parser.add_argument(
+        '--path-mapping', nargs=2, default=LEGACY_PATH_MAPPING, metavar=('REMOTE', 'LOCAL'),
+        help='Find the local copy of each file by replacing the REMOTE prefix of its remote path '
+             'with LOCAL. Default: %(default)s'
+    )
+
+    # Summarize the manifest
+    stats_parser = data_subparsers.add_parser(
+        'stats', help='summarize the manifest and the files synced to the local prefix')
+    _add_selection_arguments(stats_parser)
+    stats_parser.add_argument(
+        '--json', action='store_true', default=False, help='Print the stats as JSON.')
+
+
+def _selection(args):
+    return {'names': args.only, 'pattern': args.pattern, 'tag': args.tag}
+
+
+def _open_manifest(args, manifest_type=None):
+    if manifest_type is None:
+        manifest_type = DataManifestReader
+    return manifest_type(
+        args.manifest, args.local_prefix, args.remote_prefix,
+        checksum_cache=getattr(args, 'checksum_cache', None),
+        event_callback=getattr(args, 'events', None)
+    )
+
+
+def sync_main(args):
+    with _open_manifest(args) as manifest:
+        manifest.sync(
+            args.local_prefix,
+            n_jobs=args.jobs,
+            max_bytes_in_flight=args.max_bytes_in_flight,
+            chunk_size=args.chunk_size,
+            n_chunk_jobs=args.chunk_jobs,
+            dedupe=args.dedupe,
+            content_store_dir=args.content_store_dir,
+            delta=args.delta,
+            prune=args.prune,
+            **_selection(args)
+        )
+
+
+def verify_main(args):
+    with _open_manifest(args) as manifest:
+        if args.stat_only:
+            report = manifest.verify_sizes(args.local_prefix, n_jobs=args.jobs, **_selection(args))
+        else:
+            report = manifest.verify(
+                args.local_prefix, check_md5sums=args.check_md5sums or args.force, n_jobs=args.jobs,
+                force=args.force, report=True, **_selection(args)
+            )
+
+    if args.json:
+        json.dump(report.to_dict(), sys.stdout, indent=2)
+        print()
+    else:
+        for failure in report.failures:
+            print(f"{failure.reason}\t{failure.name}\t{failure.message}")
+        print(
+            f"Verified {report.n_records} records ({report.n_bytes} bytes) in "
+            f"'{report.local_prefix}' in {report.duration:.1f}s (hashing took "
+            f"{report.hash_time:.1f}s): {len(report.missing)} missing, "
+            f"{len(report.mismatched)} mismatched."
+        )
+    if not report.ok:
+        sys.exit(1)
+
+
+def add_main(args):
+    with _open_manifest(args, DataManifestWriter) as manifest:
+        manifest.add_file(
+            args.name, args.fname, args.local_relative_path, args.remote_relative_path,
+            note=args.note, part_size=args.part_size, n_jobs=args.jobs
+        )
+
+
+def remove_main(args):
+    with _open_manifest(args, DataManifestWriter) as manifest, manifest.transaction():
+        for name in args.names:
+            manifest.remove_file(name)
+
+
+def _read_manifest_version(manifest_fname, revision, fname, side):
+    """Read the records of the manifest file 'fname', or of a git revision of 'manifest_fname'."""
+    if fname is None:
+        return read_manifest_records(manifest_fname, revision=revision)
+    if revision is not None:
+        raise ValueError(
+            f"Both a revision ('{revision}') and a file ('{fname}') were given for the {side} "
+            f"manifest"
+        )
+    return read_manifest_records(fname)
+
+
+def diff_main(args):
+    old_revision = args.old
+    if old_revision is None and args.old_file is None:
+        old_revision = 'HEAD'
+    diff = diff_manifests(
+        _read_manifest_version(args.manifest, old_revision, args.old_file, 'old'),
+        _read_manifest_version(args.manifest, args.new, args.new_file, 'new')
+    )
+    if args.json:
+        json.dump({
+            'added': [dict(record._asdict()) for record in diff.added],
+            'removed': [dict(record._asdict()) for record in diff.removed],
+            'changed': [
+                {'old': dict(old._asdict()), 'new': dict(new._asdict())}
+                for old, new in diff.changed
+            ],
+        }, sys.stdout, indent=2)
+        print()
+        return
+
+    for record in diff.added:
+        print(f"+\t{record.name}\t{record.relative_local_path}")
+    for record in diff.removed:
+        print(f"-\t{record.name}\t{record.relative_local_path}")
+    for old, new in diff.changed:
+        fields = [
+            f"{field}: '{old_value}' -> '{new_value}'"
+            for field, old_value, new_value in zip(old._fields, old, new)
+            if old_value != new_value
+        ]
+        print(f"~\t{new.name}\t{', '.join(fields)}")
+
+
+def stats_main(args):
+    with _open_manifest(args) as manifest:
+        records = manifest.select(**_selection(args))
+        synced_records = manifest.synced_records(args.local_prefix)
+    n_bytes_by_tag = defaultdict(int)
+    for record in records:
+        for tag in parse_tags(record.notes):
+            n_bytes_by_tag[tag] += int(record.size)
+    stats = {
+        'manifest': args.manifest,
+        'n_records': len(records),
+        'bytes': sum(int(record.size) for record in records),
+        'n_unique_files': len({record.md5sum for record in records}),
+        'unique_bytes': sum({record.md5sum: int(record.size) for record in records}.values()),
+        'largest_bytes': max((int(record.size) for record in records), default=0),
+        'bytes_by_tag': dict(sorted(n_bytes_by_tag.items())),
+        'local_prefix': args.local_prefix,
+        'n_synced': sum(
+            _sync_key(record) == _sync_key(synced_records.get(record.name)) for record in records),
+    }
+
+    if args.json:
+        json.dump(stats, sys.stdout, indent=2)
+        print()
+    else:
+        for key, value in stats.items():
+            print(f"{key}\t{value}")
+
+
+def migrate_main(args):
+    migrate_legacy_manifest(
+        args.legacy_manifest, args.manifest, args.remote_prefix, args.local_prefix,
+        path_mapping=tuple(args.path_mapping), n_jobs=args.jobs, checksum_cache=args.checksum_cache
+    )
+
+
+def data_main(args):
+    if args.local_prefix is None and args.data_command != 'migrate':
+        args.local_prefix = DEFAULT_LOCAL_PREFIX
+
+    if args.data_command == 'sync':
+        sync_main(args)
+    elif args.data_command == 'verify':
+        verify_main(args)
+    elif args.data_command == 'add':
+        add_main(args)
+    elif args.data_command == 'remove':
+        remove_main(args)
+    elif args.data_command == 'diff':
+        diff_main(args)
+    elif args.data_command == 'stats':
+        stats_main(args)
+    elif args.data_command == 'migrate':
+        migrate_main(args)
+    else:
+        raise ValueError(f"Unrecognized data subcommand '{args.data_command}'")
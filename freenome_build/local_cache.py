@@ -0,0 +1,132 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import contextlib
+import logging
+
+import portalocker
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """Keep the files under a local prefix within a byte budget.
+
+    The size and last access time of each file is stored in a SQLite database (by default
+    '{local_prefix}/.cache.sqlite'), which can be shared by every process on the host. 'evict'
+    removes the least recently used files until the total size is under 'max_bytes'.
+
+    A job pins the files that it is using with 'pin', which holds a shared lock on a pin file in
+    '{local_prefix}/.cache-pins/'. Eviction needs an exclusive lock on the pin file, so a pinned
+    file is never evicted, and pins are released automatically if the job dies.
+    """
+    def __init__(self, local_prefix, max_bytes, db_fname=None):
+        self.local_prefix = local_prefix
+        self.max_bytes = max_bytes
+        self._pins_dir = os.path.join(local_prefix, '.cache-pins')
+        os.makedirs(self._pins_dir, exist_ok=True)
+
+        self.db_fname = db_fname or os.path.join(local_prefix, '.cache.sqlite')
+        # the connection is shared by the sync worker threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_fname, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "  path TEXT PRIMARY KEY,"
+                "  size INTEGER NOT NULL,"
+                "  last_access REAL NOT NULL"
+                ")"
+            )
+
+    def _pin_fname(self, path):
+        # pin files are never removed (see _try_evict), so keep them out of the data directories
+        path_hash = hashlib.sha1(os.path.abspath(path).encode('utf8')).hexdigest()
+        return os.path.join(self._pins_dir, path_hash)
+
+    def touch(self, path, size=None):
+        """Record that 'path' was just accessed."""
+        if size is None:
+            size = os.path.getsize(path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, last_access) VALUES (?, ?, ?)",
+                (os.path.abspath(path), size, time.time())
+            )
+
+    def forget(self, path):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(path),))
+
+    def size(self):
+        """Return the total size of the tracked files."""
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+
+    @contextlib.contextmanager
+    def pin(self, path):
+        """Prevent 'path' from being evicted (by any process) inside of this block."""
+        with open(self._pin_fname(path), 'a') as fp:
+            portalocker.lock(fp, portalocker.LOCK_SH)
+            try:
+                yield
+            finally:
+                portalocker.unlock(fp)
+
+    def _try_evict(self, path):
+        """Remove 'path' unless it is pinned, and return True if it was removed."""
+        # we don't remove the pin file, because a process that is waiting to pin the old pin file
+        # could then pin a file that was re-downloaded without anything else seeing the pin
+        with open(self._pin_fname(path), 'a') as fp:
+            try:
+                portalocker.lock(fp, portalocker.LOCK_EX | portalocker.LOCK_NB)
+            except portalocker.LockException:
+                return False
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            finally:
+                portalocker.unlock(fp)
+        return True
+
+    def evict(self, reserve_bytes=0, keep=frozenset()):
+        """Evict the least recently used files until there is room for 'reserve_bytes' more bytes.
+
+        The absolute paths in 'keep' (e.g. the files that a sync is downloading) are never
+        evicted. Returns the list of evicted paths.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, size FROM files ORDER BY last_access").fetchall()
+        total_bytes = sum(size for _, size in rows)
+        evicted = []
+        for path, size in rows:
+            if total_bytes + reserve_bytes <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            # files that were removed by something else don't need to be evicted
+            if not os.path.exists(path):
+                self.forget(path)
+                total_bytes -= size
+            elif self._try_evict(path):
+                logger.info(f"Evicted '{path}' ({size} bytes) from the local cache.")
+                self.forget(path)
+                total_bytes -= size
+                evicted.append(path)
+            else:
+                logger.debug(f"Not evicting '{path}' because it is pinned.")
+
+        if total_bytes + reserve_bytes > self.max_bytes:
+            logger.warning(
+                f"The local cache at '{self.local_prefix}' is using {total_bytes} bytes (with "
+                f"{reserve_bytes} bytes reserved) but the budget is {self.max_bytes} bytes, "
+                f"because the remaining files are pinned or in use."
+            )
+        return evicted
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
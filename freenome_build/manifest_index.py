@@ -0,0 +1,185 @@
+"""A compiled, indexed sidecar for data manifests.
+
+Parsing a large manifest TSV into a DataManifestReader reads and materializes every record. A
+manifest index is a binary sidecar (by default '{manifest_fname}.idx') that is built from the
+TSV, and supports O(1) lookup by name with records materialized lazily from an mmap. The TSV is
+always the source of truth: the index stores the TSV's size, mtime, inode and md5sum, and
+ManifestIndex.open rebuilds the index whenever the size, mtime or inode no longer match (e.g.
+after the TSV was replaced by a rename within the same second).
+
+The index file layout (all integers are little endian) is:
+
+    header:   magic, TSV size, TSV mtime_ns, TSV inode, TSV md5sum, number of records, number of
+              hash slots, length of the TSV header line
+    slots:    (name hash, record offset, record length) for an open addressing hash table
+    order:    (record offset, record length) for each record in manifest order
+    records:  the TSV header line followed by the utf8 encoded record lines
+"""
+import os
+import mmap
+import struct
+import hashlib
+import logging
+from collections.abc import Mapping
+
+from freenome_build.checksum_cache import stat_signature
+from freenome_build.data_manifest import (
+    DataManifestRecord, _parse_manifest_lines, calc_md5sum_from_fp
+)
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'FBMIDX02'
+_HEADER = struct.Struct('<8sQqQ24sQQQ')
+_SLOT = struct.Struct('<QQQ')
+_ORDER = struct.Struct('<QQ')
+
+
+def _hash_name(name):
+    # python's hash() is randomized per process, so use a stable hash
+    name_hash = int.from_bytes(hashlib.blake2b(name.encode('utf8'), digest_size=8).digest(), 'little')
+    # 0 marks an empty slot
+    return name_hash or 1
+
+
+def build_manifest_index(manifest_fname, index_fname=None):
+    """Build the index for 'manifest_fname' and return the index filename."""
+    if index_fname is None:
+        index_fname = f"{manifest_fname}.idx"
+
+    with open(manifest_fname) as fp:
+        signature = stat_signature(fp.fileno())
+        md5sum = calc_md5sum_from_fp(fp)
+        header, records = _parse_manifest_lines(fp, manifest_fname)
+
+    header_data = "\t".join(header).encode('utf8')
+    n_slots = 1
+    while n_slots < 2*len(records):
+        n_slots *= 2
+    slots = [(0, 0, 0)]*n_slots
+    order = []
+    records_offset = _HEADER.size + n_slots*_SLOT.size + len(records)*_ORDER.size
+    offset = records_offset + len(header_data)
+    chunks = [header_data]
+    for name, record in records.items():
+        data = "\t".join(record).encode('utf8')
+        name_hash = _hash_name(name)
+        slot_i = name_hash % n_slots
+        while slots[slot_i][0] != 0:
+            slot_i = (slot_i + 1) % n_slots
+        slots[slot_i] = (name_hash, offset, len(data))
+        order.append((offset, len(data)))
+        chunks.append(data)
+        offset += len(data)
+
+    tmp_fname = f"{index_fname}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_fname, 'wb') as ofp:
+            ofp.write(_HEADER.pack(
+                _MAGIC, signature[0], signature[1], signature[2], md5sum.encode('ascii'),
+                len(records), n_slots, len(header_data)
+            ))
+            ofp.write(b''.join(_SLOT.pack(*slot) for slot in slots))
+            ofp.write(b''.join(_ORDER.pack(*entry) for entry in order))
+            ofp.writelines(chunks)
+        os.replace(tmp_fname, index_fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+    logger.info(f"Built index '{index_fname}' for {len(records)} records in '{manifest_fname}'.")
+    return index_fname
+
+
+class ManifestIndex(Mapping):
+    """A read only mapping from record names to DataManifestRecords, backed by an index file."""
+    def __init__(self, index_fname):
+        self.fname = index_fname
+        with open(index_fname, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic, self.tsv_size, self.tsv_mtime_ns, self.tsv_ino, md5sum,
+            self._n_records, self._n_slots, header_len
+        ) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"'{index_fname}' is not a manifest index")
+        self.md5sum = md5sum.decode('ascii')
+        self._slots_offset = _HEADER.size
+        self._order_offset = self._slots_offset + self._n_slots*_SLOT.size
+        records_offset = self._order_offset + self._n_records*_ORDER.size
+        self.header = self._mmap[records_offset:records_offset + header_len].decode('utf8')
+
+    @classmethod
+    def open(cls, manifest_fname, index_fname=None):
+        """Open the index for 'manifest_fname', (re)building it if it is missing or out of date.
+
+        The index is rebuilt whenever the TSV's size, mtime or inode no longer match those recorded
+        in the index (or the index was written by an older version). This is done even if the
+        TSV's contents are unchanged (e.g. after a checkout rewrote it), so that the index records
+        the new signature and later opens don't need to hash the TSV to find out that the index is
+        still valid.
+        """
+        if index_fname is None:
+            index_fname = f"{manifest_fname}.idx"
+        if os.path.exists(index_fname):
+            try:
+                index = cls(index_fname)
+            except ValueError:
+                logger.info(f"Rebuilding '{index_fname}', because it isn't a current manifest index.")
+            else:
+                # the TSV hasn't been touched, so we can skip hashing it
+                if stat_signature(manifest_fname) == (index.tsv_size, index.tsv_mtime_ns, index.tsv_ino):
+                    return index
+                logger.info(f"'{manifest_fname}' has been modified since '{index_fname}' was built.")
+                index.close()
+        return cls(build_manifest_index(manifest_fname, index_fname))
+
+    def _record(self, offset, length):
+        line = self._mmap[offset:offset + length].decode('utf8')
+        return DataManifestRecord(*line.split("\t"))
+
+    def _lookup(self, name):
+        """Return the (offset, length) of record 'name', or raise a KeyError."""
+        name_hash = _hash_name(name)
+        name_prefix = name.encode('utf8') + b"\t"
+        slot_i = name_hash % self._n_slots
+        while True:
+            slot_hash, offset, length = _SLOT.unpack_from(
+                self._mmap, self._slots_offset + slot_i*_SLOT.size)
+            if slot_hash == 0:
+                raise KeyError(name)
+            if slot_hash == name_hash and self._mmap[offset:offset + len(name_prefix)] == name_prefix:
+                return offset, length
+            slot_i = (slot_i + 1) % self._n_slots
+
+    def __getitem__(self, name):
+        return self._record(*self._lookup(name))
+
+    def position(self, name):
+        """Return a key that sorts record names into manifest order."""
+        # records are stored in manifest order, so their offsets are in manifest order
+        return self._lookup(name)[0]
+
+    def _order(self):
+        for record_i in range(self._n_records):
+            yield _ORDER.unpack_from(self._mmap, self._order_offset + record_i*_ORDER.size)
+
+    def __iter__(self):
+        for offset, length in self._order():
+            yield self._mmap[offset:offset + length].split(b"\t", 1)[0].decode('utf8')
+
+    def __len__(self):
+        return self._n_records
+
+    def records(self):
+        """Yield every record in manifest order."""
+        for offset, length in self._order():
+            yield self._record(offset, length)
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,81 @@
+"""Structured events for data manifest transfers.
+
+DataManifestReader and DataManifestWriter take an optional 'event_callback', which is called with
+a dict for every file that is downloaded, uploaded or verified, and for the summary at the end of
+each sync and verify. Every event has 'event' (the event type), 'time' and 'manifest' fields, and
+transfer events have:
+
+    name, path        the record name and the local path
+    bytes             the size of the file
+    duration          the wall time in seconds
+    transfer_time     the time spent moving bytes to or from GCS (duration - hash_time)
+    hash_time         the time spent calculating checksums
+    throughput        bytes per second of wall time
+
+JsonLinesEventWriter is a callback that appends the events to a JSON lines file.
+"""
+import json
+import threading
+
+
+def throughput(n_bytes, duration):
+    """Return the bytes per second, or None if 'duration' is 0."""
+    return n_bytes/duration if duration > 0 else None
+
+
+class JsonLinesEventWriter:
+    """An event callback that appends each event to 'fname' as a line of JSON."""
+    def __init__(self, fname):
+        self.fname = fname
+        # events are emitted by the sync and upload worker threads
+        self._lock = threading.Lock()
+        self._fp = open(fname, 'a')
+
+    def __call__(self, event):
+        line = json.dumps(event, sort_keys=True) + "\n"
+        with self._lock:
+            self._fp.write(line)
+            self._fp.flush()
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+class TransferSummary:
+    """Accumulate transfer events into the summary event for a sync or verify."""
+    def __init__(self):
+        self.n_records = 0
+        self.n_bytes = 0
+        self.n_transferred = 0
+        self.transferred_bytes = 0
+        self.transfer_time = 0.0
+        self.hash_time = 0.0
+        self.resumed_bytes = 0
+
+    def add(self, n_records, n_bytes, event=None):
+        """Add 'n_records' records of 'n_bytes' bytes, and the transfer 'event' if there was one."""
+        self.n_records += n_records
+        self.n_bytes += n_bytes
+        if event is None:
+            return
+        self.hash_time += event['hash_time']
+        if event['event'] in ('download', 'upload'):
+            self.n_transferred += 1
+            self.transferred_bytes += event['bytes']
+            self.transfer_time += event['transfer_time']
+            self.resumed_bytes += event.get('resumed_bytes', 0)
+
+    def fields(self, duration):
+        return {
+            'n_records': self.n_records,
+            'bytes': self.n_bytes,
+            'n_transferred': self.n_transferred,
+            'transferred_bytes': self.transferred_bytes,
+            'resumed_bytes': self.resumed_bytes,
+            'duration': duration,
+            'transfer_time': self.transfer_time,
+            'hash_time': self.hash_time,
+            'throughput': throughput(self.n_bytes, duration),
+            'transfer_throughput': throughput(self.transferred_bytes, self.transfer_time),
+        }
@@ -4,8 +4,13 @@ import re
 import contextlib
 import subprocess
 import logging
+import threading
 import urllib
 
+import requests.adapters
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud.storage.client import Client
 
 import conda_build.api
@@ -14,6 +19,15 @@ from conda_build.config import Config as CondaBuildConfig
 
 logger = logging.getLogger(__file__)  # noqa: invalid-name
 
+# the number of HTTP connections that each GCS client keeps open; this should be at least the
+# number of threads that transfer files at once
+GCS_HTTP_POOL_SIZE = 64
+
+# GCS clients (and their HTTP sessions) are shared by every thread in the process
+_GCS_CLIENTS = {}
+_GCS_BUCKETS = {}
+_GCS_CACHE_LOCK = threading.Lock()
+
 
 class YamlNotFoundError(Exception):
     pass
@@ -31,12 +45,84 @@ def get_yaml_path(repo_path):
         return yaml_fpath
 
 
-def get_gcs_blob(gcp_project, remote_prefix, remote_relative_path):
+def _build_gcs_client(gcp_project):
+    # if STORAGE_EMULATOR_HOST is set then the client talks to a local fake GCS server (which
+    # doesn't need credentials) instead of GCS
+    if os.environ.get('STORAGE_EMULATOR_HOST'):
+        credentials, default_project = AnonymousCredentials(), 'test'
+    else:
+        credentials, default_project = google.auth.default(scopes=Client.SCOPE)
+
+    session = AuthorizedSession(credentials)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=GCS_HTTP_POOL_SIZE, pool_maxsize=GCS_HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return Client(gcp_project or default_project, credentials=credentials, _http=session)
+
+
+def get_gcs_client(gcp_project=None):
+    """Return the process wide GCS client for 'gcp_project'.
+
+    The client is created on first use so that credential discovery only happens once, and its
+    HTTP connection pool is sized for many concurrent transfers.
+    """
+    with _GCS_CACHE_LOCK:
+        if gcp_project not in _GCS_CLIENTS:
+            logger.debug(f"Creating a GCS client for project '{gcp_project}'.")
+            _GCS_CLIENTS[gcp_project] = _build_gcs_client(gcp_project)
+        return _GCS_CLIENTS[gcp_project]
+
+
+def get_gcs_bucket(bucket_name, gcp_project=None):
+    client = get_gcs_client(gcp_project)
+    with _GCS_CACHE_LOCK:
+        key = (gcp_project, bucket_name)
+        if key not in _GCS_BUCKETS:
+            _GCS_BUCKETS[key] = client.bucket(bucket_name)
+        return _GCS_BUCKETS[key]
+
+
+def clear_gcs_client_cache():
+    """Drop the cached GCS clients (e.g. after changing STORAGE_EMULATOR_HOST)."""
+    with _GCS_CACHE_LOCK:
+        _GCS_CLIENTS.clear()
+        _GCS_BUCKETS.clear()
+
+
+def _reset_gcs_client_cache_after_fork():
+    # another thread may have held the lock when the process forked, in which case it stays locked
+    # forever in the child, so the child gets a new lock rather than acquiring the old one
+    global _GCS_CACHE_LOCK
+    _GCS_CACHE_LOCK = threading.Lock()
+    _GCS_CLIENTS.clear()
+    _GCS_BUCKETS.clear()
+
+
+# forked child processes must not share the parent's HTTP connections
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_gcs_client_cache_after_fork)
+
+
+def get_gcs_blob(remote_prefix, remote_relative_path, gcp_project=None):
     absolute_remote_path = remote_prefix + remote_relative_path
     res = urllib.parse.urlsplit(absolute_remote_path)
     rel_path = res.path[1:]
-    blob = Client(gcp_project).bucket(res.netloc).blob(rel_path)
-    return blob
+    return get_gcs_bucket(res.netloc, gcp_project).blob(rel_path)
+
+
+def list_gcs_blobs(remote_prefix, remote_relative_prefix='', gcp_project=None, fields=None):
+    """Yield '(remote_relative_path, blob)' for every blob under 'remote_prefix + remote_relative_prefix'.
+
+    This makes one (paginated) list request rather than one request per blob. 'fields' can be
+    used to restrict the blob properties that are returned, e.g. 'items(name,size),nextPageToken'.
+    """
+    res = urllib.parse.urlsplit(remote_prefix)
+    bucket_prefix = res.path[1:]
+    blobs = get_gcs_client(gcp_project).list_blobs(
+        res.netloc, prefix=bucket_prefix + remote_relative_prefix, fields=fields)
+    for blob in blobs:
+        yield blob.name[len(bucket_prefix):], blob
 
 
 def run_and_log(cmd, input=None):
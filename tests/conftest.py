@@ -0,0 +1,83 @@
+import os
+import base64
+import hashlib
+import tempfile
+
+import pytest
+
+from fake_gcs_server import FakeGCSServer
+from freenome_build import data_manifest
+from freenome_build.data_manifest import DataManifestReader, DataManifestWriter
+
+MANIFEST_HEADER = "name\trelative_local_path\trelative_remote_path\tmd5sum\tsize\tnotes\n"
+
+
+def md5sum(data):
+    """Return the base64 encoded md5sum of 'data', as it is stored in a manifest."""
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+def write_manifest(fname, records):
+    """Write a manifest with 'records', an iterable of (name, local, remote, md5sum, size, notes)."""
+    with open(fname, 'w') as ofp:
+        ofp.write(MANIFEST_HEADER)
+        for record in records:
+            ofp.write("\t".join(str(field) for field in record) + "\n")
+
+
+def count_md5sum_calls(monkeypatch):
+    """Record the filename of every file that is hashed with calc_md5sum_from_fname."""
+    calc_md5sum_from_fname = data_manifest.calc_md5sum_from_fname
+    fnames = []
+
+    def counting_calc_md5sum_from_fname(fname, *args, **kwargs):
+        fnames.append(fname)
+        return calc_md5sum_from_fname(fname, *args, **kwargs)
+
+    monkeypatch.setattr(data_manifest, 'calc_md5sum_from_fname', counting_calc_md5sum_from_fname)
+    return fnames
+
+
+class FakeGCSManifest:
+    """A manifest in a temporary directory whose files are stored in a FakeGCSServer."""
+    bucket = 'bucket'
+    remote_prefix = 'gs://bucket/reference-data/'
+
+    def __init__(self, server, dirname):
+        self.server = server
+        self.dirname = dirname
+        self.manifest_fname = os.path.join(dirname, 'data-manifest.tsv')
+        self.local_prefix = os.path.join(dirname, 'local')
+
+    def write(self, files, local_paths=None, notes=None):
+        """Upload 'files', a dict of name to data, and write a manifest that references them.
+
+        The files are stored locally at 'data/{name}' unless 'local_paths' maps the name to another
+        path, and 'notes' maps names to the record notes.
+        """
+        local_paths = local_paths or {}
+        notes = notes or {}
+        records = []
+        for name, data in files.items():
+            self.server.put(self.bucket, f'reference-data/{name}', data)
+            records.append((
+                name, local_paths.get(name, f'data/{name}'), name, md5sum(data), len(data),
+                notes.get(name, '')
+            ))
+        write_manifest(self.manifest_fname, records)
+        return self.manifest_fname
+
+    def local_path(self, relative_local_path):
+        return os.path.join(self.local_prefix, relative_local_path)
+
+    def reader(self, **kwargs):
+        return DataManifestReader(self.manifest_fname, self.local_prefix, self.remote_prefix, **kwargs)
+
+    def writer(self, **kwargs):
+        return DataManifestWriter(self.manifest_fname, self.local_prefix, self.remote_prefix, **kwargs)
+
+
+@pytest.fixture
+def gcs_manifest():
+    with FakeGCSServer() as server, tempfile.TemporaryDirectory() as dirname:
+        yield FakeGCSManifest(server, dirname)
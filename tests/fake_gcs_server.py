@@ -0,0 +1,280 @@
+"""A minimal in-process fake of the GCS JSON API.
+
+This implements just enough of the API for google.cloud.storage to get object metadata, list,
+download (including byte ranges), upload (multipart and resumable), compose, patch and delete
+objects. The client is pointed at the server through the STORAGE_EMULATOR_HOST environment
+variable, e.g.
+
+    with FakeGCSServer() as server:
+        server.put('bucket', 'path/to/object', b'DATA')
+        ...
+"""
+import os
+import re
+import json
+import base64
+import hashlib
+import itertools
+import threading
+import socketserver
+import urllib.parse
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import google_crc32c
+
+from freenome_build.util import clear_gcs_client_cache
+
+
+def _object_resource(bucket, name, obj):
+    resource = {
+        'kind': 'storage#object',
+        'id': f'{bucket}/{name}/{obj["generation"]}',
+        'bucket': bucket,
+        'name': name,
+        'size': str(len(obj['data'])),
+        'generation': str(obj['generation']),
+        'metageneration': '1',
+        'contentType': 'application/octet-stream',
+        'crc32c': base64.b64encode(
+            google_crc32c.Checksum(obj['data']).digest()).decode('ascii'),
+        'metadata': obj['metadata'],
+    }
+    # like GCS, composite objects don't have an md5Hash
+    if not obj['composite']:
+        resource['md5Hash'] = base64.b64encode(hashlib.md5(obj['data']).digest()).decode('ascii')
+    return resource
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def _parse(self):
+        url = urllib.parse.urlsplit(self.path)
+        return url.path, dict(urllib.parse.parse_qsl(url.query))
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send(self, status, body=b'', headers=None):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+            headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self):
+        self._send(404, {'error': {'code': 404, 'message': 'Not Found'}})
+
+    def do_GET(self):
+        path, query = self._parse()
+        self.fake.n_requests += 1
+        match = re.match(r'^(/download)?/storage/v1/b/([^/]+)/o/(.+)$', path)
+        if match:
+            bucket, name = match.group(2), urllib.parse.unquote(match.group(3))
+            obj = self.fake.objects.get((bucket, name))
+            if obj is None:
+                return self._not_found()
+            if query.get('alt') != 'media':
+                return self._send(200, _object_resource(bucket, name, obj))
+            return self._send_media(bucket, name, obj)
+
+        match = re.match(r'^/storage/v1/b/([^/]+)/o$', path)
+        if match:
+            return self._list(match.group(1), query)
+
+        self._not_found()
+
+    def _send_media(self, bucket, name, obj):
+        self.fake.downloads.append((bucket, name))
+        data = obj['data']
+        resource = _object_resource(bucket, name, obj)
+        headers = {'x-goog-generation': resource['generation']}
+        range_header = self.headers.get('Range')
+        if range_header:
+            start, end = re.match(r'bytes=(\d+)-(\d*)', range_header).groups()
+            start = int(start)
+            end = min(int(end) if end else len(data) - 1, len(data) - 1)
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+            return self._send(206, data[start:end + 1], headers)
+
+        hashes = [f"crc32c={resource['crc32c']}"]
+        if 'md5Hash' in resource:
+            hashes.append(f"md5={resource['md5Hash']}")
+        headers['x-goog-hash'] = ','.join(hashes)
+        self._send(200, data, headers)
+
+    def _list(self, bucket, query):
+        prefix = query.get('prefix', '')
+        names = sorted(
+            name for (obj_bucket, name) in self.fake.objects
+            if obj_bucket == bucket and name.startswith(prefix)
+        )
+        start = int(query.get('pageToken', 0))
+        page_size = min(int(query.get('maxResults', 1000)), self.fake.page_size)
+        page = names[start:start + page_size]
+        response = {
+            'kind': 'storage#objects',
+            'items': [
+                _object_resource(bucket, name, self.fake.objects[(bucket, name)])
+                for name in page
+            ]
+        }
+        if start + page_size < len(names):
+            response['nextPageToken'] = str(start + page_size)
+        self._send(200, response)
+
+    def do_POST(self):
+        path, query = self._parse()
+        self.fake.n_requests += 1
+        body = self._body()
+
+        match = re.match(r'^/upload/storage/v1/b/([^/]+)/o$', path)
+        if match:
+            bucket = match.group(1)
+            upload_type = query.get('uploadType')
+            if upload_type == 'media':
+                return self._finish_upload(bucket, query['name'], body, {})
+            if upload_type == 'multipart':
+                message = BytesParser().parsebytes(
+                    b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+                metadata_part, data_part = message.get_payload()
+                metadata = json.loads(metadata_part.get_payload(decode=True))
+                return self._finish_upload(
+                    bucket, metadata['name'], data_part.get_payload(decode=True), metadata)
+            if upload_type == 'resumable':
+                metadata = json.loads(body) if body else {}
+                name = query.get('name', metadata.get('name'))
+                upload_id = str(next(self.fake.upload_ids))
+                self.fake.uploads[upload_id] = (bucket, name, metadata, bytearray())
+                location = (
+                    f'http://{self.headers["Host"]}/upload/storage/v1/b/{bucket}/o'
+                    f'?uploadType=resumable&upload_id={upload_id}'
+                )
+                return self._send(200, b'', {'Location': location})
+
+        match = re.match(r'^/storage/v1/b/([^/]+)/o/(.+)/compose$', path)
+        if match:
+            bucket, name = match.group(1), urllib.parse.unquote(match.group(2))
+            request = json.loads(body)
+            data = b''.join(
+                self.fake.objects[(bucket, source['name'])]['data']
+                for source in request['sourceObjects']
+            )
+            metadata = request.get('destination', {}).get('metadata') or {}
+            obj = self.fake.put(bucket, name, data, metadata, composite=True)
+            return self._send(200, _object_resource(bucket, name, obj))
+
+        self._not_found()
+
+    def do_PUT(self):
+        path, query = self._parse()
+        self.fake.n_requests += 1
+        body = self._body()
+        bucket, name, metadata, data = self.fake.uploads[query['upload_id']]
+        data.extend(body)
+        content_range = self.headers.get('Content-Range', '')
+        total = content_range.rsplit('/', 1)[-1]
+        if total != '*' and len(data) == int(total):
+            del self.fake.uploads[query['upload_id']]
+            return self._finish_upload(bucket, name, bytes(data), metadata)
+        headers = {'Range': f'bytes=0-{len(data) - 1}'} if data else {}
+        self._send(308, b'', headers)
+
+    def do_PATCH(self):
+        path, query = self._parse()
+        self.fake.n_requests += 1
+        body = json.loads(self._body())
+        match = re.match(r'^/storage/v1/b/([^/]+)/o/(.+)$', path)
+        bucket, name = match.group(1), urllib.parse.unquote(match.group(2))
+        obj = self.fake.objects.get((bucket, name))
+        if obj is None:
+            return self._not_found()
+        obj['metadata'] = dict(obj['metadata'] or {}, **(body.get('metadata') or {}))
+        self._send(200, _object_resource(bucket, name, obj))
+
+    def do_DELETE(self):
+        path, query = self._parse()
+        self.fake.n_requests += 1
+        match = re.match(r'^/storage/v1/b/([^/]+)/o/(.+)$', path)
+        key = (match.group(1), urllib.parse.unquote(match.group(2)))
+        if key not in self.fake.objects:
+            return self._not_found()
+        del self.fake.objects[key]
+        self._send(204)
+
+    def _finish_upload(self, bucket, name, data, metadata):
+        obj = self.fake.put(bucket, name, data, metadata.get('metadata'))
+        self._send(200, _object_resource(bucket, name, obj))
+
+
+class FakeGCSServer:
+    def __init__(self, page_size=1000):
+        self.objects = {}
+        self.uploads = {}
+        self.upload_ids = itertools.count()
+        self.page_size = page_size
+        self.n_requests = 0
+        # the (bucket, name) of every media download, including byte ranges
+        self.downloads = []
+        self._generation = 0
+        self._httpd = None
+        self._prev_emulator_host = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f'http://{host}:{port}'
+
+    def put(self, bucket, name, data, metadata=None, composite=False):
+        self._generation += 1
+        obj = {
+            'data': bytes(data),
+            'metadata': metadata,
+            'generation': self._generation,
+            'composite': composite,
+        }
+        self.objects[(bucket, name)] = obj
+        return obj
+
+    def get(self, bucket, name):
+        return self.objects[(bucket, name)]['data']
+
+    def start(self):
+        self._httpd = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._httpd.fake = self
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        self._prev_emulator_host = os.environ.get('STORAGE_EMULATOR_HOST')
+        os.environ['STORAGE_EMULATOR_HOST'] = self.url
+        clear_gcs_client_cache()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._prev_emulator_host is None:
+            del os.environ['STORAGE_EMULATOR_HOST']
+        else:
+            os.environ['STORAGE_EMULATOR_HOST'] = self._prev_emulator_host
+        clear_gcs_client_cache()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
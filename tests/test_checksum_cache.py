@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+from freenome_build.checksum_cache import ChecksumCache, stat_signature
+
+
+def _write(fname, data):
+    with open(fname, 'w') as ofp:
+        ofp.write(data)
+
+
+def test_cached_md5sum_is_returned():
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = ChecksumCache(os.path.join(dirname, 'cache.sqlite'))
+        fname = os.path.join(dirname, 'data.txt')
+        _write(fname, 'AAAAAAAA')
+        cache.set(fname, 'MD5SUM')
+        assert cache.get(fname) == 'MD5SUM'
+        # the cache should persist
+        assert ChecksumCache(cache.fname).get(fname) == 'MD5SUM'
+
+
+def test_modified_file_is_not_returned():
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = ChecksumCache(os.path.join(dirname, 'cache.sqlite'))
+        fname = os.path.join(dirname, 'data.txt')
+        _write(fname, 'AAAAAAAA')
+        signature = stat_signature(fname)
+        cache.set(fname, 'MD5SUM', signature)
+        _write(fname, 'CCCCCCCCCC')
+        assert cache.get(fname) is None
+
+
+def test_invalidate():
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = ChecksumCache(os.path.join(dirname, 'cache.sqlite'))
+        fname_1 = os.path.join(dirname, 'data_1.txt')
+        fname_2 = os.path.join(dirname, 'data_2.txt')
+        _write(fname_1, 'AAAAAAAA')
+        _write(fname_2, 'CCCCCCCC')
+        cache.set(fname_1, 'MD5SUM_1')
+        cache.set(fname_2, 'MD5SUM_2')
+        cache.invalidate(fname_1)
+        assert cache.get(fname_1) is None
+        assert cache.get(fname_2) == 'MD5SUM_2'
+        cache.invalidate()
+        assert cache.get(fname_2) is None
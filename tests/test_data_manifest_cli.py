@@ -0,0 +1,97 @@
+import os
+import json
+import argparse
+import subprocess
+
+import pytest
+
+from freenome_build.data_manifest import add_data_subparser, data_main
+
+
+def _run(gcs_manifest, *args):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    add_data_subparser(subparsers)
+    args = parser.parse_args([
+        'data', '--manifest', gcs_manifest.manifest_fname,
+        '--local-prefix', gcs_manifest.local_prefix,
+        '--remote-prefix', gcs_manifest.remote_prefix,
+    ] + list(args))
+    data_main(args)
+
+
+def _run_json(gcs_manifest, capsys, *args):
+    capsys.readouterr()
+    _run(gcs_manifest, *args)
+    return json.loads(capsys.readouterr().out)
+
+
+def test_sync_verify_and_stats(gcs_manifest, capsys):
+    gcs_manifest.write(
+        {'file_0': b'AA', 'file_1': b'CCCC', 'file_2': b'AA'},
+        notes={'file_0': 'tags=hg38', 'file_1': 'tags=hg38,fasta'}
+    )
+    _run(gcs_manifest, 'sync', '--jobs', '2', '--tag', 'hg38')
+    assert sorted(os.listdir(gcs_manifest.local_path('data'))) == ['file_0', 'file_1']
+
+    stats = _run_json(gcs_manifest, capsys, 'stats', '--json')
+    assert stats['n_records'] == 3
+    assert stats['n_unique_files'] == 2
+    assert stats['bytes_by_tag'] == {'fasta': 4, 'hg38': 6}
+    assert stats['n_synced'] == 2
+
+    report = _run_json(gcs_manifest, capsys, 'verify', '--check-md5sums', '--only', 'file_1', '--json')
+    assert report['ok'] is True
+    with pytest.raises(SystemExit) as exc_info:
+        _run(gcs_manifest, 'verify', '--stat-only')
+    assert exc_info.value.code == 1
+    assert 'missing\tfile_2' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('verify_args', [
+    ['--stat-only', '--check-md5sums'], ['--stat-only', '--force']])
+def test_verify_rejects_conflicting_modes(gcs_manifest, verify_args):
+    gcs_manifest.write({'file_0': b'AA'})
+    with pytest.raises(SystemExit):
+        _run(gcs_manifest, 'verify', *verify_args)
+
+
+def test_add_and_remove(gcs_manifest):
+    gcs_manifest.write({'file_0': b'AA'})
+    fname = os.path.join(gcs_manifest.dirname, 'new_file')
+    with open(fname, 'wb') as ofp:
+        ofp.write(b'GGG')
+    _run(gcs_manifest, 'add', 'file_1', fname, 'data/file_1', 'file_1', '--note', 'tags=new')
+    assert gcs_manifest.server.get('bucket', 'reference-data/file_1') == b'GGG'
+    assert gcs_manifest.reader()['file_1'].notes == 'tags=new'
+    _run(gcs_manifest, 'remove', 'file_0')
+    assert list(gcs_manifest.reader()) == ['file_1']
+
+
+def test_diff(gcs_manifest, capsys, monkeypatch):
+    def git(*args):
+        subprocess.run(['git'] + list(args), cwd=gcs_manifest.dirname, check=True,
+                       stdout=subprocess.DEVNULL)
+
+    manifest_fname = gcs_manifest.write({'file_0': b'A', 'file_1': b'C'})
+    git('init', '-q')
+    git('add', 'data-manifest.tsv')
+    git('-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'Add')
+    old_fname = os.path.join(gcs_manifest.dirname, 'old-manifest.tsv')
+    os.rename(manifest_fname, old_fname)
+    gcs_manifest.write({'file_1': b'CC', 'file_2': b'G'})
+    # a file named like a revision is not read as a manifest
+    monkeypatch.chdir(gcs_manifest.dirname)
+    with open('HEAD', 'w') as ofp:
+        ofp.write("not a manifest\n")
+
+    for args in [[], ['HEAD'], ['--old-file', old_fname]]:
+        diff = _run_json(gcs_manifest, capsys, 'diff', '--json', *args)
+        assert [record['name'] for record in diff['added']] == ['file_2']
+        assert [record['name'] for record in diff['removed']] == ['file_0']
+        assert [change['new']['name'] for change in diff['changed']] == ['file_1']
+
+    diff = _run_json(gcs_manifest, capsys, 'diff', '--json', '--old-file', old_fname, '--new-file', old_fname)
+    assert diff == {'added': [], 'removed': [], 'changed': []}
+    with pytest.raises(ValueError):
+        _run(gcs_manifest, 'diff', 'HEAD', '--old-file', old_fname)
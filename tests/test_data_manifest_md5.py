@@ -0,0 +1,55 @@
+import base64
+import hashlib
+import os
+import tempfile
+
+import pytest
+
+from freenome_build import data_manifest
+from freenome_build.data_manifest import calc_md5sum_from_fname, calc_md5sums_from_fnames
+
+
+def _expected_md5sum(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+def _write(fname, data):
+    with open(fname, 'wb') as ofp:
+        ofp.write(data)
+    return fname
+
+
+@pytest.mark.parametrize('size', [0, 1, 100, 1024, 1025, 10000])
+def test_calc_md5sum_from_fname(size):
+    data = os.urandom(size)
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = _write(os.path.join(dirname, 'data.bin'), data)
+        assert calc_md5sum_from_fname(fname) == _expected_md5sum(data)
+        # a small buffer spreads the file over several reads
+        assert calc_md5sum_from_fname(fname, buffer_size=64) == _expected_md5sum(data)
+        assert calc_md5sum_from_fname(fname, buffer_size=size + 1) == _expected_md5sum(data)
+
+
+def test_calc_md5sum_from_fname_buffer_is_no_larger_than_the_file(monkeypatch):
+    buffer_sizes = []
+
+    def recording_bytearray(size):
+        buffer_sizes.append(size)
+        return bytearray(size)
+
+    monkeypatch.setattr(data_manifest, 'bytearray', recording_bytearray, raising=False)
+    with tempfile.TemporaryDirectory() as dirname:
+        for fname, data in [('small.bin', b'A'*10), ('empty.bin', b''), ('large.bin', b'A'*1000)]:
+            fname = _write(os.path.join(dirname, fname), data)
+            assert calc_md5sum_from_fname(fname, buffer_size=100) == _expected_md5sum(data)
+    assert buffer_sizes == [10, 1, 100]
+
+
+def test_calc_md5sums_from_fnames_keeps_the_input_order():
+    datas = [os.urandom(size) for size in (50000, 0, 10, 20000, 1, 3000)]
+    expected = [_expected_md5sum(data) for data in datas]
+    with tempfile.TemporaryDirectory() as dirname:
+        fnames = [_write(os.path.join(dirname, f'data_{i}.bin'), data) for i, data in enumerate(datas)]
+        assert calc_md5sums_from_fnames(fnames, n_jobs=4) == expected
+        assert calc_md5sums_from_fnames(fnames[::-1], n_jobs=4) == expected[::-1]
+    assert calc_md5sums_from_fnames([]) == []
@@ -0,0 +1,75 @@
+import os
+import tempfile
+
+import pytest
+
+from conftest import md5sum
+from freenome_build.data_manifest import (
+    DataManifestReader, MissingFileError, migrate_legacy_manifest
+)
+
+REMOTE_PREFIX = 'gs://balrog/reference-data/'
+
+
+def _setup(dirname, files):
+    """Write the local copies of 'files' and a legacy manifest that references them."""
+    srv_dirname = os.path.join(dirname, 'srv') + '/'
+    legacy_fname = os.path.join(dirname, 'legacy.tsv')
+    with open(legacy_fname, 'w') as ofp:
+        ofp.write("name\tpath\tremote_path\tnotes\n")
+        for name, data in files.items():
+            ofp.write(f"{name}\t/old/{name}\t{REMOTE_PREFIX}{name}.txt\thg38\n")
+            if data is not None:
+                os.makedirs(os.path.join(srv_dirname, 'reference-data'), exist_ok=True)
+                with open(os.path.join(srv_dirname, 'reference-data', f'{name}.txt'), 'wb') as fp:
+                    fp.write(data)
+    return legacy_fname, ('gs://balrog/', srv_dirname)
+
+
+def test_migrate_legacy_manifest():
+    with tempfile.TemporaryDirectory() as dirname:
+        files = {'file_1': b'AAAA', 'file_2': b'CCCCCC', 'file_3': b''}
+        legacy_fname, path_mapping = _setup(dirname, files)
+        output_fname = os.path.join(dirname, 'data-manifest.tsv')
+        migrate_legacy_manifest(
+            legacy_fname, output_fname, REMOTE_PREFIX, path_mapping=path_mapping, n_jobs=2)
+
+        local_prefix = os.path.join(path_mapping[1], 'reference-data')
+        manifest = DataManifestReader(output_fname, local_prefix, REMOTE_PREFIX)
+        assert list(manifest) == list(files)
+        for name, data in files.items():
+            record = manifest[name]
+            assert record.relative_local_path == f'{name}.txt'
+            assert record.relative_remote_path == f'{name}.txt'
+            assert record.md5sum == md5sum(data)
+            assert record.size == str(len(data))
+            assert record.notes == f'hg38 old_path:/old/{name}'
+        manifest.verify(local_prefix, check_md5sums=True)
+        assert not os.path.exists(f'{output_fname}.partial')
+
+
+def test_migrate_legacy_manifest_resumes():
+    with tempfile.TemporaryDirectory() as dirname:
+        files = {'file_1': b'AAAA', 'file_2': b'CCCCCC', 'file_3': None}
+        legacy_fname, path_mapping = _setup(dirname, files)
+        output_fname = os.path.join(dirname, 'data-manifest.tsv')
+        # file_3 is missing, so the migration fails after the other files have been hashed
+        with pytest.raises(MissingFileError):
+            migrate_legacy_manifest(
+                legacy_fname, output_fname, REMOTE_PREFIX, path_mapping=path_mapping)
+        assert not os.path.exists(output_fname)
+
+        # mark file_1's progress so that we can tell that it isn't re-hashed
+        partial_fname = f'{output_fname}.partial'
+        with open(partial_fname) as fp:
+            lines = fp.read().replace(md5sum(b'AAAA'), 'PREVIOUS_MD5SUM')
+        with open(partial_fname, 'w') as ofp:
+            # include a line that was only partially written
+            ofp.write(lines + 'file_3\tfile_3.t')
+
+        with open(os.path.join(path_mapping[1], 'reference-data', 'file_3.txt'), 'wb') as fp:
+            fp.write(b'GG')
+        records = migrate_legacy_manifest(
+            legacy_fname, output_fname, REMOTE_PREFIX, path_mapping=path_mapping)
+        assert [record.md5sum for record in records] == [
+            'PREVIOUS_MD5SUM', md5sum(b'CCCCCC'), md5sum(b'GG')]
@@ -0,0 +1,63 @@
+import pytest
+
+from freenome_build.data_manifest import parse_tags
+
+
+def test_parse_tags():
+    assert parse_tags('') == []
+    assert parse_tags('GRCh38 reference genome') == []
+    assert parse_tags('tags=hg38') == ['hg38']
+    assert parse_tags('GRCh38 tags=hg38,fasta, downloaded from UCSC') == ['hg38', 'fasta']
+    assert parse_tags('tags=hg38 old_path:/srv/hg38.fa') == ['hg38']
+    assert parse_tags('ntags=hg38') == []
+
+
+@pytest.fixture
+def manifest(gcs_manifest):
+    gcs_manifest.write(
+        {'chr1': b'A', 'chr2': b'C', 'chrM': b'G', 'dbsnp': b'T'},
+        local_paths={
+            'chr1': 'hg38/chr1.fa', 'chr2': 'hg38/chr2.fa', 'chrM': 'hg38/chrM.fa',
+            'dbsnp': 'annotations/dbsnp.vcf'
+        },
+        notes={
+            'chr1': 'GRCh38 tags=hg38,fasta', 'chr2': 'tags=hg38,fasta', 'chrM': 'hg38 mitochondria',
+            'dbsnp': 'tags=hg38 old_path:/srv/dbsnp.vcf'
+        }
+    )
+    return gcs_manifest.reader()
+
+
+def _names(records):
+    return [record.name for record in records]
+
+
+def test_select_all(manifest):
+    assert _names(manifest.select()) == ['chr1', 'chr2', 'chrM', 'dbsnp']
+
+
+def test_select_names(manifest):
+    # records are returned in manifest order
+    assert _names(manifest.select(names=['dbsnp', 'chr1', 'dbsnp'])) == ['chr1', 'dbsnp']
+    with pytest.raises(KeyError):
+        manifest.select(names=['chr1', 'chrX'])
+
+
+def test_select_pattern(manifest):
+    assert _names(manifest.select(pattern='hg38/*.fa')) == ['chr1', 'chr2', 'chrM']
+    assert _names(manifest.select(pattern='hg38/chr[12].fa')) == ['chr1', 'chr2']
+    assert _names(manifest.select(pattern='*/dbsnp.vcf')) == ['dbsnp']
+    assert manifest.select(pattern='hg19/*') == []
+
+
+def test_select_tag(manifest):
+    assert _names(manifest.select(tag='hg38')) == ['chr1', 'chr2', 'dbsnp']
+    assert _names(manifest.select(tag='fasta')) == ['chr1', 'chr2']
+    # words in the rest of the notes aren't tags
+    assert manifest.select(tag='mitochondria') == []
+    assert manifest.select(tag='old_path:/srv/dbsnp.vcf') == []
+
+
+def test_select_combined(manifest):
+    assert _names(manifest.select(names=['chr2', 'chrM', 'dbsnp'], tag='fasta')) == ['chr2']
+    assert _names(manifest.select(pattern='hg38/*', tag='hg38')) == ['chr1', 'chr2']
@@ -0,0 +1,254 @@
+import os
+import subprocess
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from google.cloud.storage.blob import Blob
+
+from conftest import FakeGCSManifest, md5sum
+from freenome_build.data_manifest import (
+    DataManifestReader, _ByteBudget, diff_manifests, read_manifest_records
+)
+
+
+N_RECORDS = 4
+N_NODES = 8
+
+
+def _sync_node(manifest_fname, local_prefix, shared_dir):
+    manifest = DataManifestReader(manifest_fname, local_prefix, FakeGCSManifest.remote_prefix)
+    manifest.sync(local_prefix, n_jobs=2, dedupe=True, content_store_dir=shared_dir)
+    manifest.verify(local_prefix, check_md5sums=True)
+
+
+def test_coordinated_sync_downloads_each_file_once(gcs_manifest):
+    server, dirname = gcs_manifest.server, gcs_manifest.dirname
+    manifest_fname = gcs_manifest.write({
+        f'file_{record_i}': os.urandom(100000 + record_i) for record_i in range(N_RECORDS)
+    })
+    shared_dir = os.path.join(dirname, 'shared')
+    # each process plays the part of a node with its own local prefix
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(
+            target=_sync_node,
+            args=(manifest_fname, os.path.join(dirname, f'node_{node_i}'), shared_dir)
+        )
+        for node_i in range(N_NODES)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    assert len(server.downloads) == N_RECORDS
+    for node_i in range(N_NODES):
+        assert sorted(os.listdir(os.path.join(dirname, f'node_{node_i}', 'data'))) == [
+            f'file_{record_i}' for record_i in range(N_RECORDS)
+        ]
+
+
+def _get_local_path(manifest_fname, local_prefix):
+    manifest = DataManifestReader(manifest_fname, local_prefix, FakeGCSManifest.remote_prefix)
+    manifest.get_local_path('file_0')
+
+
+def test_concurrent_get_local_path_downloads_once(gcs_manifest):
+    data = os.urandom(1000000)
+    manifest_fname = gcs_manifest.write({'file_0': data})
+    manifest = gcs_manifest.reader()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        local_paths = list(executor.map(lambda _: manifest.get_local_path('file_0'), range(8)))
+    assert set(local_paths) == {gcs_manifest.local_path('data/file_0')}
+    assert gcs_manifest.server.downloads == [('bucket', 'reference-data/file_0')]
+
+    os.remove(local_paths[0])
+    del gcs_manifest.server.downloads[:]
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(target=_get_local_path, args=(manifest_fname, gcs_manifest.local_prefix))
+        for _ in range(8)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    assert gcs_manifest.server.downloads == [('bucket', 'reference-data/file_0')]
+    with open(local_paths[0], 'rb') as fp:
+        assert fp.read() == data
+
+
+def _downloaded_names(server):
+    return sorted(name.split('/', 1)[1] for _, name in server.downloads)
+
+
+def test_delta_sync_skips_unchanged_records(gcs_manifest):
+    files = {f'file_{i}': os.urandom(100) for i in range(4)}
+    gcs_manifest.write(files)
+    gcs_manifest.reader().sync(gcs_manifest.local_prefix)
+    assert _downloaded_names(gcs_manifest.server) == sorted(files)
+
+    # add a record and change another one
+    files['file_4'] = os.urandom(100)
+    files['file_1'] = os.urandom(100)
+    gcs_manifest.write(files)
+    del gcs_manifest.server.downloads[:]
+    manifest = gcs_manifest.reader()
+    manifest.sync(gcs_manifest.local_prefix, delta=True)
+    assert _downloaded_names(gcs_manifest.server) == ['file_1', 'file_4']
+    # the changed record's local file was replaced
+    with open(gcs_manifest.local_path('data/file_1'), 'rb') as fp:
+        assert fp.read() == files['file_1']
+    manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
+    assert list(manifest.synced_records(gcs_manifest.local_prefix).values()) == list(manifest.values())
+
+    del gcs_manifest.server.downloads[:]
+    manifest.sync(gcs_manifest.local_prefix, delta=True)
+    assert gcs_manifest.server.downloads == []
+
+
+def test_prune_keeps_paths_of_renamed_records(gcs_manifest):
+    files = {'file_a': b'A', 'file_b': b'B', 'file_c': b'C'}
+    gcs_manifest.write(files)
+    gcs_manifest.reader().sync(gcs_manifest.local_prefix)
+
+    # drop file_a, and rename file_b to file_d without moving its local file
+    gcs_manifest.write(
+        {'file_d': b'B', 'file_c': b'C'}, local_paths={'file_d': 'data/file_b'})
+    manifest = gcs_manifest.reader()
+    manifest.sync(gcs_manifest.local_prefix, delta=True, prune=True)
+    assert sorted(os.listdir(gcs_manifest.local_path('data'))) == ['file_b', 'file_c']
+    assert list(manifest.synced_records(gcs_manifest.local_prefix)) == ['file_c', 'file_d']
+    manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
+
+
+def test_failed_sync_resumes_with_delta(gcs_manifest, monkeypatch):
+    files = {f'file_{i}': os.urandom(100) for i in range(6)}
+    gcs_manifest.write(files)
+    manifest = gcs_manifest.reader()
+    download_to_file = Blob.download_to_file
+    calls = []
+
+    def failing_download_to_file(self, *args, **kwargs):
+        calls.append(None)
+        if len(calls) == 3:
+            raise ConnectionError("Simulated network failure")
+        return download_to_file(self, *args, **kwargs)
+
+    monkeypatch.setattr(Blob, 'download_to_file', failing_download_to_file)
+    with pytest.raises(ConnectionError):
+        manifest.sync(gcs_manifest.local_prefix)
+    monkeypatch.undo()
+    synced = manifest.synced_records(gcs_manifest.local_prefix)
+    # the records that were synced before the failure are recorded
+    assert {'file_0', 'file_1'}.issubset(synced) and 'file_2' not in synced
+
+    del gcs_manifest.server.downloads[:]
+    manifest.sync(gcs_manifest.local_prefix, delta=True)
+    downloaded = _downloaded_names(gcs_manifest.server)
+    assert 'file_2' in downloaded
+    assert not set(downloaded) & set(synced)
+    assert list(manifest.synced_records(gcs_manifest.local_prefix)) == sorted(files)
+    manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
+
+
+def test_read_manifest_records_from_revision(gcs_manifest):
+    def git(*args):
+        subprocess.run(['git'] + list(args), cwd=gcs_manifest.dirname, check=True,
+                       stdout=subprocess.DEVNULL)
+
+    manifest_fname = gcs_manifest.write({'file_0': b'A', 'file_1': b'C'})
+    git('init', '-q')
+    git('add', 'data-manifest.tsv')
+    git('-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'Add')
+    old_records = read_manifest_records(manifest_fname)
+    gcs_manifest.write({'file_1': b'CC', 'file_2': b'G'})
+
+    assert read_manifest_records(manifest_fname, revision='HEAD') == old_records
+    diff = diff_manifests(
+        read_manifest_records(manifest_fname, revision='HEAD'), read_manifest_records(manifest_fname))
+    assert [record.name for record in diff.added] == ['file_2']
+    assert [record.name for record in diff.removed] == ['file_0']
+    assert [(old.name, new.md5sum) for old, new in diff.changed] == [('file_1', md5sum(b'CC'))]
+
+
+def test_dedupe_sync_downloads_identical_files_once(gcs_manifest):
+    gcs_manifest.write({'file_a': b'AAAA', 'file_b': b'AAAA', 'file_c': b'CCCC'})
+    manifest = gcs_manifest.reader()
+    manifest.sync(gcs_manifest.local_prefix, n_jobs=2, dedupe=True)
+    assert _downloaded_names(gcs_manifest.server) in (['file_a', 'file_c'], ['file_b', 'file_c'])
+    assert os.stat(gcs_manifest.local_path('data/file_a')).st_ino == \
+        os.stat(gcs_manifest.local_path('data/file_b')).st_ino
+    manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
+
+
+def test_dedupe_sync_reuses_existing_local_files(gcs_manifest):
+    gcs_manifest.write({'file_a': b'AAAA', 'file_b': b'AAAA', 'file_c': b'CCCC'})
+    manifest = gcs_manifest.reader()
+    manifest.sync(gcs_manifest.local_prefix)
+    assert len(gcs_manifest.server.downloads) == 3
+
+    del gcs_manifest.server.downloads[:]
+    manifest.sync(gcs_manifest.local_prefix, dedupe=True)
+    assert gcs_manifest.server.downloads == []
+    # the existing copies are replaced with links to the content store
+    assert os.stat(gcs_manifest.local_path('data/file_a')).st_ino == \
+        os.stat(gcs_manifest.local_path('data/file_b')).st_ino
+    manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
+
+
+def test_byte_budget_never_blocks_a_transfer_larger_than_the_budget():
+    budget = _ByteBudget(100)
+    with budget.reserve(1000):
+        pass
+    with budget.reserve(60):
+        assert not budget._has_room_for(60)
+        assert budget._has_room_for(40)
+    assert _ByteBudget()._has_room_for(10**12)
+
+
+def _record_bytes_in_flight(monkeypatch):
+    """Record the peak number of bytes that are being downloaded at once."""
+    download_blob = DataManifestReader._download_blob
+    lock = threading.Lock()
+    state = {'in_flight': 0, 'peak': 0}
+
+    def slow_download_blob(self, blob, record, local_abs_path):
+        with lock:
+            state['in_flight'] += int(record.size)
+            state['peak'] = max(state['peak'], state['in_flight'])
+        try:
+            # give the other threads a chance to start their downloads
+            time.sleep(0.05)
+            return download_blob(self, blob, record, local_abs_path)
+        finally:
+            with lock:
+                state['in_flight'] -= int(record.size)
+
+    monkeypatch.setattr(DataManifestReader, '_download_blob', slow_download_blob)
+    return state
+
+
+def test_sync_limits_the_bytes_in_flight(gcs_manifest, monkeypatch):
+    gcs_manifest.write({f'file_{record_i}': os.urandom(1000) for record_i in range(6)})
+    state = _record_bytes_in_flight(monkeypatch)
+    manifest = gcs_manifest.reader()
+    manifest.sync(gcs_manifest.local_prefix, n_jobs=4, max_bytes_in_flight=1500)
+    assert state['peak'] == 1000
+    manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
+
+
+def test_sync_downloads_a_file_larger_than_the_bytes_in_flight(gcs_manifest, monkeypatch):
+    files = {f'file_{record_i}': os.urandom(1000) for record_i in range(4)}
+    files['large_file'] = os.urandom(5000)
+    gcs_manifest.write(files)
+    state = _record_bytes_in_flight(monkeypatch)
+    manifest = gcs_manifest.reader()
+    manifest.sync(gcs_manifest.local_prefix, n_jobs=4, max_bytes_in_flight=1500)
+    # the large file is downloaded on its own
+    assert state['peak'] == 5000
+    manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
@@ -0,0 +1,200 @@
+import os
+
+import pytest
+from google.cloud.storage.blob import Blob
+
+from conftest import count_md5sum_calls, md5sum
+from freenome_build.data_manifest import FileMismatchError, GCS_MAX_COMPOSE_SOURCES, get_blob_md5sum
+from freenome_build.util import get_gcs_blob
+
+
+CHUNK_SIZE = 100
+N_CHUNKS = 10
+
+
+def _fail_on_call(monkeypatch, method_name, n_calls):
+    """Make the 'n_calls'th call to Blob.'method_name' raise an error."""
+    method = getattr(Blob, method_name)
+    calls = []
+
+    def failing_method(self, *args, **kwargs):
+        calls.append(None)
+        if len(calls) == n_calls:
+            raise ConnectionError("Simulated network failure")
+        return method(self, *args, **kwargs)
+
+    monkeypatch.setattr(Blob, method_name, failing_method)
+
+
+def _write_file(dirname, data):
+    fname = os.path.join(dirname, 'upload.bin')
+    with open(fname, 'wb') as ofp:
+        ofp.write(data)
+    return fname
+
+
+def _tmp_blob_names(server):
+    return [name for (_, name) in server.objects if '.part-' in name or '.compose-' in name]
+
+
+def test_download_is_verified_before_it_is_moved_into_place(gcs_manifest, monkeypatch):
+    data = os.urandom(1000)
+    gcs_manifest.write({'file_1': data})
+    manifest = gcs_manifest.reader(
+        checksum_cache=os.path.join(gcs_manifest.dirname, 'checksums.sqlite'))
+    local_path = gcs_manifest.local_path('data/file_1')
+
+    # the remote file has the right size but the wrong contents
+    gcs_manifest.server.put('bucket', 'reference-data/file_1', b'X'*len(data))
+    with pytest.raises(FileMismatchError):
+        manifest.get_local_path('file_1')
+    assert not os.path.exists(local_path)
+    assert not [fname for fname in os.listdir(os.path.dirname(local_path)) if fname.endswith('.tmp')]
+
+    gcs_manifest.server.put('bucket', 'reference-data/file_1', data)
+    manifest.get_local_path('file_1')
+    with open(local_path, 'rb') as fp:
+        assert fp.read() == data
+    # the md5sum was calculated during the download, so it isn't calculated again
+    assert manifest.checksum_cache.get(local_path) == md5sum(data)
+    hashed_fnames = count_md5sum_calls(monkeypatch)
+    manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
+    assert hashed_fnames == []
+    manifest.close()
+
+
+def test_interrupted_chunked_download_resumes(gcs_manifest, monkeypatch):
+    data = os.urandom(CHUNK_SIZE*N_CHUNKS - 1)
+    gcs_manifest.write({'file_1': data})
+    events = []
+    manifest = gcs_manifest.reader(event_callback=events.append)
+
+    _fail_on_call(monkeypatch, 'download_as_bytes', 4)
+    with pytest.raises(ConnectionError):
+        manifest.get_local_path('file_1', chunk_size=CHUNK_SIZE)
+    monkeypatch.undo()
+    local_path = gcs_manifest.local_path('data/file_1')
+    assert not os.path.exists(local_path)
+    with open(f'{local_path}.partial.chunks') as fp:
+        completed_chunks = [int(line) for line in fp.read().splitlines()[1:]]
+    # the chunks before the failure were saved (the pool may have started one more before it
+    # was shut down)
+    assert {0, 1, 2}.issubset(completed_chunks) and len(completed_chunks) < N_CHUNKS
+
+    del gcs_manifest.server.downloads[:]
+    manifest.get_local_path('file_1', chunk_size=CHUNK_SIZE)
+    # only the chunks that weren't downloaded before the failure are fetched
+    assert len(gcs_manifest.server.downloads) == N_CHUNKS - len(completed_chunks)
+    assert events[-1]['resumed_bytes'] == len(completed_chunks)*CHUNK_SIZE
+    with open(local_path, 'rb') as fp:
+        assert fp.read() == data
+    assert not os.path.exists(f'{local_path}.partial')
+    assert not os.path.exists(f'{local_path}.partial.chunks')
+
+
+@pytest.mark.parametrize('stale_header', [
+    f'{CHUNK_SIZE//2}\t{CHUNK_SIZE*N_CHUNKS}\tMD5SUM',
+    f'{CHUNK_SIZE}\t{CHUNK_SIZE*N_CHUNKS}\tOLD_MD5SUM',
+])
+def test_stale_chunked_download_restarts(gcs_manifest, stale_header):
+    data = os.urandom(CHUNK_SIZE*N_CHUNKS)
+    gcs_manifest.write({'file_1': data})
+    manifest = gcs_manifest.reader()
+    # progress left behind by a download with a different chunk size or of an older file
+    local_path = gcs_manifest.local_path('data/file_1')
+    os.makedirs(os.path.dirname(local_path))
+    with open(f'{local_path}.partial', 'wb') as fp:
+        fp.write(b'X'*len(data))
+    with open(f'{local_path}.partial.chunks', 'w') as fp:
+        fp.write(stale_header + "\n" + "".join(f"{chunk_i}\n" for chunk_i in range(N_CHUNKS)))
+
+    manifest.get_local_path('file_1', chunk_size=CHUNK_SIZE)
+    assert len(gcs_manifest.server.downloads) == N_CHUNKS
+    with open(local_path, 'rb') as fp:
+        assert fp.read() == data
+
+
+def test_upload_in_parts(gcs_manifest, monkeypatch):
+    gcs_manifest.write({})
+    # enough parts that they have to be composed in two rounds
+    n_parts = 2*GCS_MAX_COMPOSE_SOURCES + 3
+    data = os.urandom(10*n_parts)
+    fname = _write_file(gcs_manifest.dirname, data)
+    composed = []
+    compose = Blob.compose
+
+    def recording_compose(self, sources, *args, **kwargs):
+        composed.append((self.name, len(sources)))
+        return compose(self, sources, *args, **kwargs)
+
+    monkeypatch.setattr(Blob, 'compose', recording_compose)
+    manifest = gcs_manifest.writer()
+    manifest.add_file('file_1', fname, 'data/file_1', 'file_1', part_size=10, n_jobs=4)
+
+    assert composed == [
+        ('reference-data/file_1.compose-0-00000', GCS_MAX_COMPOSE_SOURCES),
+        ('reference-data/file_1.compose-0-00001', GCS_MAX_COMPOSE_SOURCES),
+        ('reference-data/file_1.compose-0-00002', 3),
+        ('reference-data/file_1', 3),
+    ]
+    assert gcs_manifest.server.get('bucket', 'reference-data/file_1') == data
+    assert manifest['file_1'].md5sum == md5sum(data)
+    # GCS doesn't calculate the md5sum of composite objects, so it is stored in the metadata
+    blob = get_gcs_blob(gcs_manifest.remote_prefix, 'file_1')
+    blob.reload()
+    assert blob.md5_hash is None
+    assert blob.metadata['md5sum'] == md5sum(data)
+    assert get_blob_md5sum(blob) == md5sum(data)
+    assert _tmp_blob_names(gcs_manifest.server) == []
+
+
+def test_failed_upload_in_parts_deletes_parts(gcs_manifest, monkeypatch):
+    gcs_manifest.write({})
+    fname = _write_file(gcs_manifest.dirname, os.urandom(100))
+    _fail_on_call(monkeypatch, 'upload_from_string', 5)
+    manifest = gcs_manifest.writer()
+    with pytest.raises(ConnectionError):
+        manifest.add_file('file_1', fname, 'data/file_1', 'file_1', part_size=10, n_jobs=2)
+    assert 'file_1' not in manifest
+    assert list(gcs_manifest.server.objects) == []
+
+
+@pytest.mark.parametrize('read_size', [7, CHUNK_SIZE, 3*CHUNK_SIZE + 1, -1])
+def test_open_stream(gcs_manifest, read_size):
+    data = os.urandom(CHUNK_SIZE*N_CHUNKS + 5)
+    gcs_manifest.write({'file_1': data})
+    manifest = gcs_manifest.reader()
+    chunks = []
+    with manifest.open_stream('file_1', chunk_size=CHUNK_SIZE, n_read_ahead=2) as fp:
+        for chunk in iter(lambda: fp.read(read_size), b''):
+            chunks.append(chunk)
+    assert b''.join(chunks) == data
+    # the file is fetched in chunk_size byte ranges
+    assert len(gcs_manifest.server.downloads) == N_CHUNKS + 1
+    # nothing is written locally
+    assert not os.path.exists(gcs_manifest.local_prefix)
+
+
+def test_open_stream_text(gcs_manifest):
+    lines = [f'line {i}\tμ\n' for i in range(100)]
+    gcs_manifest.write({'file_1': ''.join(lines).encode('utf8')})
+    manifest = gcs_manifest.reader()
+    with manifest.open_stream('file_1', mode='r', chunk_size=CHUNK_SIZE, encoding='utf8') as fp:
+        assert list(fp) == lines
+
+
+def test_open_stream_empty_file(gcs_manifest):
+    gcs_manifest.write({'file_1': b''})
+    with gcs_manifest.reader().open_stream('file_1', chunk_size=CHUNK_SIZE) as fp:
+        assert fp.read() == b''
+
+
+@pytest.mark.parametrize('corrupt_data', [b'X'*CHUNK_SIZE*N_CHUNKS, b'X'*(CHUNK_SIZE*N_CHUNKS - 1)])
+def test_open_stream_detects_corruption(gcs_manifest, corrupt_data):
+    gcs_manifest.write({'file_1': os.urandom(CHUNK_SIZE*N_CHUNKS)})
+    manifest = gcs_manifest.reader()
+    gcs_manifest.server.put('bucket', 'reference-data/file_1', corrupt_data)
+    with manifest.open_stream('file_1', chunk_size=CHUNK_SIZE) as fp:
+        with pytest.raises(FileMismatchError):
+            while fp.read(CHUNK_SIZE):
+                pass
@@ -0,0 +1,122 @@
+import os
+import json
+
+import pytest
+
+from conftest import count_md5sum_calls, md5sum
+from freenome_build.data_manifest import FileMismatchError, MissingFileError
+
+
+def test_remote_list_prefixes_skips_nested_directories(gcs_manifest):
+    files = {name: b'A' for name in ('a/1', 'a-b/1', 'a/b/1', 'a/b/c/1', 'b/1', 'ab/1')}
+    gcs_manifest.write(files)
+    manifest = gcs_manifest.reader()
+    assert sorted(manifest._remote_list_prefixes(manifest.values())) == ['a-b/', 'a/', 'ab/', 'b/']
+    assert manifest._remote_list_prefixes([manifest['a/b/1'], manifest['b/1']]) == ['a/b/', 'b/']
+
+
+def test_verify_remote(gcs_manifest):
+    files = {f'dir_{dir_i}/file_{file_i}': b'A'*file_i for dir_i in range(3) for file_i in range(5)}
+    gcs_manifest.write(files)
+    manifest = gcs_manifest.reader()
+    # make the listing paginate
+    gcs_manifest.server.page_size = 2
+    manifest.verify_remote(n_jobs=2)
+
+    del gcs_manifest.server.objects[('bucket', 'reference-data/dir_0/file_1')]
+    gcs_manifest.server.put('bucket', 'reference-data/dir_1/file_2', b'CC')
+    gcs_manifest.server.put('bucket', 'reference-data/dir_2/file_3', b'CCCC')
+    with pytest.raises(MissingFileError) as exc_info:
+        manifest.verify_remote(n_jobs=2)
+    msg = str(exc_info.value)
+    assert "Can not find 'dir_0/file_1'" in msg
+    assert "dir_1/file_2' has md5sum" in msg
+    assert "dir_2/file_3' has size '4' vs '3'" in msg
+
+    gcs_manifest.server.put('bucket', 'reference-data/dir_0/file_1', b'A')
+    with pytest.raises(FileMismatchError):
+        manifest.verify_remote()
+    # only the selected records are checked
+    manifest.verify_remote(names=['dir_0/file_1', 'dir_0/file_4'])
+
+
+def _sync_and_damage(gcs_manifest):
+    """Sync four files, and then remove one and modify the size and contents of two others."""
+    gcs_manifest.write({f'file_{i}': b'A'*10 for i in range(4)})
+    manifest = gcs_manifest.reader()
+    manifest.sync(gcs_manifest.local_prefix)
+    os.remove(gcs_manifest.local_path('data/file_0'))
+    with open(gcs_manifest.local_path('data/file_1'), 'ab') as fp:
+        fp.write(b'A')
+    with open(gcs_manifest.local_path('data/file_2'), 'r+b') as fp:
+        fp.write(b'C')
+    return manifest
+
+
+def test_verify_report(gcs_manifest):
+    manifest = _sync_and_damage(gcs_manifest)
+    report = manifest.verify(gcs_manifest.local_prefix, check_md5sums=True, n_jobs=2, report=True)
+    assert not report.ok
+    assert report.n_records == 4
+    assert report.n_bytes == 40
+    assert [(failure.name, failure.reason) for failure in report.failures] == [
+        ('file_0', 'missing'), ('file_1', 'size'), ('file_2', 'md5sum')]
+    assert [failure.name for failure in report.missing] == ['file_0']
+    assert [failure.name for failure in report.mismatched] == ['file_1', 'file_2']
+    assert all(failure.duration >= 0 for failure in report.failures)
+    assert report.duration >= report.hash_time > 0
+
+    data = json.loads(json.dumps(report.to_dict()))
+    assert data['ok'] is False
+    assert data['n_missing'] == 1 and data['n_mismatched'] == 2
+    assert [failure['reason'] for failure in data['failures']] == ['missing', 'size', 'md5sum']
+
+    with pytest.raises(MissingFileError) as exc_info:
+        report.raise_for_failures()
+    assert len(str(exc_info.value).split("\n")) == 3
+    # without a report the first failure is raised
+    with pytest.raises(MissingFileError):
+        manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
+
+
+def test_verify_sizes_report(gcs_manifest):
+    manifest = _sync_and_damage(gcs_manifest)
+    report = manifest.verify_sizes(gcs_manifest.local_prefix, n_jobs=2)
+    # the md5sum mismatch isn't found without hashing
+    assert [(failure.name, failure.reason) for failure in report.failures] == [
+        ('file_0', 'missing'), ('file_1', 'size')]
+    json.dumps(report.to_dict())
+
+    report = manifest.verify_sizes(gcs_manifest.local_prefix, names=['file_2', 'file_3'])
+    assert report.ok and report.n_records == 2
+
+
+def test_verify_uses_the_checksum_cache(gcs_manifest, monkeypatch):
+    files = {f'file_{file_i}': os.urandom(100) for file_i in range(3)}
+    gcs_manifest.write(files)
+    manifest = gcs_manifest.reader(
+        checksum_cache=os.path.join(gcs_manifest.dirname, 'checksums.sqlite'))
+    manifest.sync(gcs_manifest.local_prefix)
+    hashed_fnames = count_md5sum_calls(monkeypatch)
+    manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
+    assert hashed_fnames == []
+
+    # a file whose stat signature changed is hashed again
+    local_path = gcs_manifest.local_path('data/file_0')
+    stat = os.stat(local_path)
+    os.utime(local_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
+    assert hashed_fnames == [local_path]
+
+    # force ignores the cached md5sums and replaces them
+    local_path = gcs_manifest.local_path('data/file_1')
+    manifest.checksum_cache.set(local_path, 'WRONG')
+    with pytest.raises(FileMismatchError):
+        manifest.verify(gcs_manifest.local_prefix, names=['file_1'], check_md5sums=True)
+    del hashed_fnames[:]
+    manifest.verify(gcs_manifest.local_prefix, names=['file_1'], check_md5sums=True, force=True)
+    assert hashed_fnames == [local_path]
+    assert manifest.checksum_cache.get(local_path) == md5sum(files['file_1'])
+    manifest.verify(gcs_manifest.local_prefix, names=['file_1'], check_md5sums=True)
+    assert hashed_fnames == [local_path]
+    manifest.close()
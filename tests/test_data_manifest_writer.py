@@ -0,0 +1,125 @@
+import os
+
+import pytest
+
+from freenome_build.data_manifest import KeyAlreadyExistsError
+
+
+def _write_files(dirname, n_files):
+    fnames = []
+    for file_i in range(n_files):
+        fname = os.path.join(dirname, f'file_{file_i}')
+        with open(fname, 'wb') as ofp:
+            ofp.write(os.urandom(10 + file_i))
+        fnames.append(fname)
+    return fnames
+
+
+def _add_files_args(fnames):
+    return [
+        (os.path.basename(fname), fname, f'data/{os.path.basename(fname)}', os.path.basename(fname))
+        for fname in fnames
+    ]
+
+
+def _count_manifest_writes(monkeypatch, manifest_fname):
+    """Count the number of times that 'manifest_fname' is replaced."""
+    writes = []
+    replace = os.replace
+
+    def counting_replace(src, dst):
+        if dst == manifest_fname:
+            writes.append(src)
+        return replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', counting_replace)
+    return writes
+
+
+def _read(fname):
+    with open(fname) as fp:
+        return fp.read()
+
+
+def test_add_files_writes_the_manifest_once(gcs_manifest, monkeypatch):
+    gcs_manifest.write({'existing': b'A'})
+    fnames = _write_files(gcs_manifest.dirname, 5)
+    manifest = gcs_manifest.writer()
+    writes = _count_manifest_writes(monkeypatch, gcs_manifest.manifest_fname)
+    manifest.add_files(_add_files_args(fnames), n_jobs=3)
+    assert len(writes) == 1
+    assert list(manifest) == ['existing'] + [f'file_{file_i}' for file_i in range(5)]
+    assert list(gcs_manifest.reader()) == list(manifest)
+
+
+def test_add_files_rejects_duplicates(gcs_manifest):
+    gcs_manifest.write({'file_0': b'A'})
+    fnames = _write_files(gcs_manifest.dirname, 2)
+    manifest = gcs_manifest.writer()
+    with pytest.raises(KeyAlreadyExistsError):
+        manifest.add_files(_add_files_args(fnames))
+    with pytest.raises(KeyAlreadyExistsError):
+        manifest.add_files(_add_files_args([fnames[1], fnames[1]]))
+    # nothing is uploaded when the batch is rejected
+    assert ('bucket', 'reference-data/file_1') not in gcs_manifest.server.objects
+    assert list(manifest) == ['file_0']
+
+
+def test_transaction(gcs_manifest, monkeypatch):
+    gcs_manifest.write({'existing': b'A'})
+    fnames = _write_files(gcs_manifest.dirname, 3)
+    manifest = gcs_manifest.writer()
+    writes = _count_manifest_writes(monkeypatch, gcs_manifest.manifest_fname)
+    with manifest.transaction():
+        manifest.add_file('file_0', fnames[0], 'data/file_0', 'file_0')
+        # nested transactions are part of the outer one
+        with manifest.transaction():
+            manifest.add_file('file_1', fnames[1], 'data/file_1', 'file_1')
+            manifest.remove_file('existing')
+        assert writes == []
+    assert len(writes) == 1
+    assert list(gcs_manifest.reader()) == ['file_0', 'file_1']
+
+
+def test_transaction_rolls_back(gcs_manifest):
+    gcs_manifest.write({'existing': b'A'})
+    fnames = _write_files(gcs_manifest.dirname, 2)
+    manifest = gcs_manifest.writer()
+    contents = _read(gcs_manifest.manifest_fname)
+    with pytest.raises(ValueError):
+        with manifest.transaction():
+            manifest.add_file('file_0', fnames[0], 'data/file_0', 'file_0')
+            with manifest.transaction():
+                manifest.remove_file('existing')
+            raise ValueError("Abort the transaction")
+    assert list(manifest) == ['existing']
+    assert _read(gcs_manifest.manifest_fname) == contents
+    # the manifest is still usable after the rollback
+    manifest.add_file('file_1', fnames[1], 'data/file_1', 'file_1')
+    assert list(gcs_manifest.reader()) == ['existing', 'file_1']
+
+
+def test_stale_writer_is_rejected(gcs_manifest):
+    gcs_manifest.write({'existing': b'A'})
+    os.chmod(gcs_manifest.manifest_fname, 0o640)
+    fnames = _write_files(gcs_manifest.dirname, 2)
+    writer_1 = gcs_manifest.writer()
+    writer_2 = gcs_manifest.writer()
+    writer_1.add_file('file_0', fnames[0], 'data/file_0', 'file_0')
+    with pytest.raises(RuntimeError):
+        writer_2.add_file('file_1', fnames[1], 'data/file_1', 'file_1')
+    assert list(gcs_manifest.reader()) == ['existing', 'file_0']
+    assert os.stat(gcs_manifest.manifest_fname).st_mode & 0o777 == 0o640
+    assert not [fname for fname in os.listdir(gcs_manifest.dirname) if fname.endswith('.tmp')]
+
+
+def test_only_writers_create_the_lock_file(gcs_manifest):
+    gcs_manifest.write({'existing': b'A'})
+    lock_fname = f'{gcs_manifest.manifest_fname}.lock'
+    gcs_manifest.reader()
+    assert not os.path.exists(lock_fname)
+    manifest = gcs_manifest.writer()
+    manifest.remove_file('existing')
+    assert os.path.exists(lock_fname)
+    # readers take a shared lock once a writer has created the lock file
+    assert list(gcs_manifest.reader()) == []
@@ -0,0 +1,84 @@
+import os
+import time
+import tempfile
+
+import pytest
+
+from freenome_build.local_cache import LocalCache
+
+
+def _write_and_touch(cache, fname, size):
+    with open(fname, 'wb') as ofp:
+        ofp.write(b'A'*size)
+    cache.touch(fname)
+    # make sure that the access times are distinct
+    time.sleep(0.01)
+
+
+def test_evict_least_recently_used():
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = LocalCache(dirname, max_bytes=300)
+        fnames = [os.path.join(dirname, f'data_{i}.txt') for i in range(3)]
+        for fname in fnames:
+            _write_and_touch(cache, fname, 100)
+        # access the first file so that the second file is the least recently used
+        cache.touch(fnames[0])
+        assert cache.evict(reserve_bytes=100) == [os.path.abspath(fnames[1])]
+        assert not os.path.exists(fnames[1])
+        assert cache.size() == 200
+
+
+def test_pinned_files_are_not_evicted():
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = LocalCache(dirname, max_bytes=100)
+        fnames = [os.path.join(dirname, f'data_{i}.txt') for i in range(2)]
+        for fname in fnames:
+            _write_and_touch(cache, fname, 100)
+        with cache.pin(fnames[0]):
+            assert cache.evict() == [os.path.abspath(fnames[1])]
+            assert cache.evict(reserve_bytes=100) == []
+            assert os.path.exists(fnames[0])
+        assert cache.evict(reserve_bytes=100) == [os.path.abspath(fnames[0])]
+
+
+def test_kept_files_are_not_evicted():
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = LocalCache(dirname, max_bytes=200)
+        fnames = [os.path.join(dirname, f'data_{i}.txt') for i in range(2)]
+        for fname in fnames:
+            _write_and_touch(cache, fname, 100)
+        assert cache.evict(reserve_bytes=100, keep={os.path.abspath(fnames[0])}) == [
+            os.path.abspath(fnames[1])]
+
+
+def _synced_names(gcs_manifest):
+    return sorted(os.listdir(gcs_manifest.local_path('data')))
+
+
+def test_sync_evicts_before_each_download(gcs_manifest):
+    gcs_manifest.write({f'file_{i}': bytes([i])*100 for i in range(5)})
+    cache = LocalCache(gcs_manifest.local_prefix, max_bytes=250)
+    manifest = gcs_manifest.reader(local_cache=cache)
+
+    # the selected records are never evicted, even if they don't fit in the budget
+    manifest.sync(gcs_manifest.local_prefix, names=['file_0', 'file_1', 'file_2'])
+    assert _synced_names(gcs_manifest) == ['file_0', 'file_1', 'file_2']
+
+    # older files are evicted to make room for each download
+    manifest.sync(gcs_manifest.local_prefix, names=['file_3', 'file_4'])
+    assert _synced_names(gcs_manifest) == ['file_3', 'file_4']
+    assert cache.size() == 200
+
+    # a delta sync re-syncs the evicted files
+    del gcs_manifest.server.downloads[:]
+    manifest.sync(gcs_manifest.local_prefix, names=['file_0', 'file_3'], delta=True)
+    assert gcs_manifest.server.downloads == [('bucket', 'reference-data/file_0')]
+    assert _synced_names(gcs_manifest) == ['file_0', 'file_3']
+    manifest.verify(gcs_manifest.local_prefix, check_md5sums=True, names=['file_0', 'file_3'])
+
+
+def test_sync_with_local_cache_rejects_dedupe(gcs_manifest):
+    gcs_manifest.write({'file_0': b'A'})
+    manifest = gcs_manifest.reader(local_cache=LocalCache(gcs_manifest.local_prefix, max_bytes=100))
+    with pytest.raises(ValueError):
+        manifest.sync(gcs_manifest.local_prefix, dedupe=True)
@@ -0,0 +1,135 @@
+import os
+import shutil
+import logging
+import tempfile
+
+from conftest import write_manifest
+from freenome_build.data_manifest import DataManifestReader
+from freenome_build import manifest_index
+from freenome_build.manifest_index import ManifestIndex
+
+
+def _add_base_to_path(rel_path):
+    return os.path.normpath(os.path.join(os.path.abspath(os.path.dirname(__file__)), rel_path))
+
+
+TEST_MANIFEST_FNAME = _add_base_to_path('../tests/data/pipeline-data/data-manifest.tsv.orig')
+
+
+def _write_manifest(fname, n_records):
+    write_manifest(fname, (
+        (f'record_{i}', f'local/{i}.txt', f'remote/{i}.txt', f'MD5SUM{i}', i, f'note {i}')
+        for i in range(n_records)
+    ))
+
+
+def test_index_matches_manifest():
+    with tempfile.TemporaryDirectory() as dirname:
+        manifest_fname = os.path.join(dirname, 'data-manifest.tsv')
+        shutil.copy(TEST_MANIFEST_FNAME, manifest_fname)
+        manifest = DataManifestReader(manifest_fname, dirname, 'gs://bucket/')
+        with ManifestIndex.open(manifest_fname) as index:
+            assert list(index) == list(manifest)
+            assert list(index.records()) == list(manifest.values())
+            assert index['chrM'] == manifest['chrM']
+            assert 'missing' not in index
+
+
+def test_index_lookup():
+    with tempfile.TemporaryDirectory() as dirname:
+        manifest_fname = os.path.join(dirname, 'data-manifest.tsv')
+        _write_manifest(manifest_fname, 1000)
+        with ManifestIndex.open(manifest_fname) as index:
+            assert len(index) == 1000
+            assert index['record_567'].relative_local_path == 'local/567.txt'
+            assert index.get('record_1000') is None
+
+
+def test_index_is_rebuilt_when_manifest_changes():
+    with tempfile.TemporaryDirectory() as dirname:
+        manifest_fname = os.path.join(dirname, 'data-manifest.tsv')
+        _write_manifest(manifest_fname, 10)
+        with ManifestIndex.open(manifest_fname) as index:
+            assert len(index) == 10
+        _write_manifest(manifest_fname, 20)
+        with ManifestIndex.open(manifest_fname) as index:
+            assert len(index) == 20
+
+
+def test_index_records_new_signature_when_manifest_is_touched():
+    with tempfile.TemporaryDirectory() as dirname:
+        manifest_fname = os.path.join(dirname, 'data-manifest.tsv')
+        _write_manifest(manifest_fname, 10)
+        with ManifestIndex.open(manifest_fname) as index:
+            mtime_ns = index.tsv_mtime_ns
+        # the contents are unchanged, but the index must record the new mtime
+        os.utime(manifest_fname, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+        with ManifestIndex.open(manifest_fname) as index:
+            assert index.tsv_mtime_ns == mtime_ns + 10**9
+            assert len(index) == 10
+
+
+def test_index_is_rebuilt_when_manifest_is_replaced():
+    with tempfile.TemporaryDirectory() as dirname:
+        manifest_fname = os.path.join(dirname, 'data-manifest.tsv')
+        _write_manifest(manifest_fname, 10)
+        with ManifestIndex.open(manifest_fname) as index:
+            st = os.stat(manifest_fname)
+            assert (index.tsv_size, index.tsv_mtime_ns, index.tsv_ino) == (st.st_size, st.st_mtime_ns, st.st_ino)
+        # replace the manifest with a file of the same size and mtime, but different contents
+        new_manifest_fname = os.path.join(dirname, 'new-data-manifest.tsv')
+        with open(manifest_fname) as fp, open(new_manifest_fname, 'w') as ofp:
+            ofp.write(fp.read().replace('note 3', 'NOTE 3'))
+        os.utime(new_manifest_fname, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(new_manifest_fname, manifest_fname)
+        with ManifestIndex.open(manifest_fname) as index:
+            assert index['record_3'].notes == 'NOTE 3'
+
+
+def test_index_in_old_format_is_rebuilt():
+    with tempfile.TemporaryDirectory() as dirname:
+        manifest_fname = os.path.join(dirname, 'data-manifest.tsv')
+        _write_manifest(manifest_fname, 10)
+        with open(f'{manifest_fname}.idx', 'wb') as ofp:
+            ofp.write(b'FBMIDX01' + b'\0'*manifest_index._HEADER.size)
+        with ManifestIndex.open(manifest_fname) as index:
+            assert len(index) == 10
+
+
+def test_reader_parses_manifest_when_index_can_not_be_built(gcs_manifest, monkeypatch, caplog):
+    gcs_manifest.write({f'file_{i}': b'A'*i for i in range(10)})
+
+    def read_only_build_manifest_index(manifest_fname, index_fname=None):
+        raise PermissionError(13, 'Permission denied', f'{manifest_fname}.idx')
+
+    monkeypatch.setattr(manifest_index, 'build_manifest_index', read_only_build_manifest_index)
+    with caplog.at_level(logging.WARNING):
+        indexed_manifest = gcs_manifest.reader(use_index=True)
+    assert "Can not use an index" in caplog.text
+    assert indexed_manifest._index is None
+    assert list(indexed_manifest.items()) == list(gcs_manifest.reader().items())
+    indexed_manifest.close()
+
+
+def test_reader_uses_index(gcs_manifest):
+    files = {f'file_{i}': b'A'*i for i in range(10)}
+    gcs_manifest.write(files)
+    manifest = gcs_manifest.reader()
+    indexed_manifest = gcs_manifest.reader(use_index=True)
+    assert os.path.exists(f'{gcs_manifest.manifest_fname}.idx')
+    assert len(indexed_manifest) == len(manifest)
+    assert list(indexed_manifest) == list(manifest)
+    assert list(indexed_manifest.items()) == list(manifest.items())
+    assert indexed_manifest['file_3'] == manifest['file_3']
+    assert 'file_3' in indexed_manifest and 'missing' not in indexed_manifest
+    assert indexed_manifest.get('missing') is None
+    assert indexed_manifest.header == manifest.header
+    assert indexed_manifest.select(names=['file_7', 'file_2']) == [manifest['file_2'], manifest['file_7']]
+    assert indexed_manifest.select(pattern='data/file_[12]') == manifest.select(pattern='data/file_[12]')
+
+    local_path = indexed_manifest.get_local_path('file_5')
+    with open(local_path, 'rb') as fp:
+        assert fp.read() == files['file_5']
+    indexed_manifest.sync(gcs_manifest.local_prefix)
+    indexed_manifest.verify(gcs_manifest.local_prefix, check_md5sums=True)
+    indexed_manifest.close()
@@ -0,0 +1,58 @@
+import os
+import json
+import tempfile
+
+from freenome_build.transfer_events import JsonLinesEventWriter, TransferSummary
+
+
+def test_json_lines_event_writer():
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, 'events.jsonl')
+        writer = JsonLinesEventWriter(fname)
+        writer({'event': 'download', 'bytes': 8})
+        writer({'event': 'sync_summary', 'bytes': 8})
+        writer.close()
+        with open(fname) as fp:
+            events = [json.loads(line) for line in fp]
+        assert [event['event'] for event in events] == ['download', 'sync_summary']
+
+
+def test_transfer_summary():
+    summary = TransferSummary()
+    summary.add(1, 100, {
+        'event': 'download', 'bytes': 100, 'transfer_time': 2.0, 'hash_time': 0.5,
+        'resumed_bytes': 40
+    })
+    summary.add(1, 50, {'event': 'verify', 'bytes': 50, 'hash_time': 0.25})
+    # records that were skipped don't have an event
+    summary.add(1, 25)
+    fields = summary.fields(duration=5.0)
+    assert fields['n_records'] == 3
+    assert fields['bytes'] == 175
+    assert fields['n_transferred'] == 1
+    assert fields['transferred_bytes'] == 100
+    assert fields['resumed_bytes'] == 40
+    assert fields['hash_time'] == 0.75
+    assert fields['throughput'] == 35.0
+    assert fields['transfer_throughput'] == 50.0
+
+
+def test_manifest_closes_event_file(gcs_manifest):
+    gcs_manifest.write({'file_1': b'AAAA'})
+    events_fname = os.path.join(gcs_manifest.dirname, 'events.jsonl')
+    with gcs_manifest.reader(event_callback=events_fname) as manifest:
+        event_writer = manifest.event_callback
+        manifest.sync(gcs_manifest.local_prefix)
+    assert event_writer._fp.closed
+    with open(events_fname) as fp:
+        events = [json.loads(line) for line in fp]
+    assert [event['event'] for event in events] == ['download', 'sync_summary']
+
+
+def test_manifest_does_not_close_callbacks_it_did_not_open(gcs_manifest):
+    gcs_manifest.write({'file_1': b'AAAA'})
+    event_writer = JsonLinesEventWriter(os.path.join(gcs_manifest.dirname, 'events.jsonl'))
+    with gcs_manifest.reader(event_callback=event_writer) as manifest:
+        manifest.sync(gcs_manifest.local_prefix)
+    assert not event_writer._fp.closed
+    event_writer.close()
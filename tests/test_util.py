@@ -1,5 +1,11 @@
+import sys
 import tempfile
-from freenome_build.util import run_and_log
+import multiprocessing
+
+from freenome_build import util
+from freenome_build.util import run_and_log, get_gcs_blob, get_gcs_client
+
+from fake_gcs_server import FakeGCSServer
 
 
 def test_run_and_log():
@@ -26,3 +32,26 @@ def test_run_and_log_lots_of_data():
         ofp.write(b'a'*100000000)
         ofp.flush()
         run_and_log(f'cat {ofp.name}')
+
+
+def test_get_gcs_blob_reuses_client():
+    with FakeGCSServer() as server:
+        server.put('bucket', 'reference-data/eight_As.fa', b'AAAAAAAA')
+        blob_1 = get_gcs_blob('gs://bucket/reference-data/', 'eight_As.fa')
+        blob_2 = get_gcs_blob('gs://bucket/reference-data/', 'eight_As.fa')
+        assert blob_1.client is blob_2.client
+        assert blob_1.download_as_bytes() == b'AAAAAAAA'
+
+
+def test_forked_child_gets_new_gcs_client_while_lock_is_held():
+    with FakeGCSServer():
+        client = get_gcs_client()
+        context = multiprocessing.get_context('fork')
+        # fork while another thread holds the cache lock
+        with util._GCS_CACHE_LOCK:
+            process = context.Process(target=lambda: sys.exit(int(get_gcs_client() is client)))
+            process.start()
+        process.join(timeout=30)
+        if process.is_alive():
+            process.kill()
+        assert process.exitcode == 0